@@ -0,0 +1,305 @@
+""" Semi-Automatic Paintbrush Benchmarks
+
+Copyright (c) 2011, Nirav Patel <http://eclecti.cc>
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+Times each stage of the paint loop without a camera, an Arduino or a
+screen, so that changes can be checked against the 30Hz budget.  Uses
+SDL's dummy video driver, a port that throws away what is written to it,
+and brush strokes that are either made up or from a recorded session.
+
+StrokeSource - A fake camera that moves the brush back and forth over the canvas
+"""
+
+#!/usr/bin/env python
+
+import os
+# no window is needed, so this has to be set before pygame starts up
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import sys
+import json
+import random
+import getopt
+import timeit
+import numpy
+import pygame
+from homography import *
+from session import ReplaySource, NullPort
+from paintbrush import Paintbrush, GreyImage, dither, levels_cache
+
+timer = timeit.default_timer
+
+class StrokeSource(FakeSource):
+    """A fake camera that moves the brush back and forth over the canvas
+    
+    update() -- Return a blank image
+    get_point() -- Return the next point along the strokes
+    get_points(count) -- Return the next point of each head along the strokes
+    
+    The points are already in canvas coordinates, so use it with an
+    identity transform.  speed is how many dots the brush moves per frame.
+    With more than one head, each works its own band of the canvas.
+    """
+    
+    def __init__(self, canvas_size, speed, heads=1):
+        self.resolution = canvas_size
+        self.timestamp = None
+        self.dropped = 0
+        self.tracking = False
+        self.snapshot = pygame.surface.Surface((10,10), 0)
+        self.canvas_size = canvas_size
+        self.speed = speed
+        self.heads = heads
+        self.x = 0.0
+        self.y = 0.0
+        self.direction = 1
+    
+    def update(self):
+        """Return a blank image"""
+        return self.snapshot
+    
+    def get_point(self):
+        """Return the next point along the strokes"""
+        self.x += self.speed*self.direction
+        # at either edge, drop down a swath and head back the other way
+        if self.x < 0 or self.x >= self.canvas_size[0]:
+            self.direction = -self.direction
+            self.x += self.speed*self.direction
+            self.y = (self.y + 12) % self.canvas_size[1]
+        return (self.x, self.y)
+    
+    def get_points(self, count):
+        """Return the next point of each head along the strokes"""
+        x, y = self.get_point()
+        band = self.canvas_size[1] // self.heads
+        return [(x, (y + i*band) % self.canvas_size[1]) for i in range(min(count, self.heads))]
+
+def measure(name, func, calls, results, prepare=None):
+    # prepare runs before each call, but isn't part of the time
+    times = numpy.empty(calls)
+    for i in range(calls):
+        if prepare:
+            prepare()
+        start = timer()
+        func()
+        times[i] = timer() - start
+    mean = times.mean()
+    results[name] = {'calls': calls, 'mean': mean, 'p95': numpy.percentile(times, 95),
+                     'per_second': 1/mean if mean > 0 else float('inf')}
+    print '%-44s %9.3f %9.3f %10.1f' % (name, mean*1000, results[name]['p95']*1000, results[name]['per_second'])
+
+def blob_frames(count, resolution=(640,480)):
+    # dark frames with a soft bright dot and a few hot pixels, like the IR camera sees
+    frames = []
+    random.seed(0)
+    for i in range(count):
+        frame = pygame.surface.Surface(resolution, 0, 32)
+        frame.fill((16,16,16))
+        x = random.randint(20, resolution[0]-20)
+        y = random.randint(20, resolution[1]-20)
+        for r in range(12, 0, -1):
+            c = 255 - 6*r
+            pygame.draw.circle(frame, (c,c,c), (x,y), r)
+        for n in range(20):
+            frame.set_at((random.randrange(resolution[0]), random.randrange(resolution[1])), (255,255,255))
+        frames.append(frame)
+    return frames
+
+def make_paintbrush(filename, canvas_inches, camera, average_color=False, heads=1):
+    pb = Paintbrush(filename, None, canvas_inches, average_color=average_color, camera=camera,
+                    port=[NullPort() for i in range(heads)])
+    pb.transform = numpy.eye(3)
+    return pb
+
+def run(filename, sizes, speeds, calls, replay):
+    results = {}
+    print '%-44s %9s %9s %10s' % ('benchmark', 'mean ms', 'p95 ms', 'per second')
+    
+    for size in sizes:
+        name = '%gx%g' % size
+        canvas_size = (int(size[0]*96), int(size[1]*96))
+        measure('prepare image %s' % name, lambda: GreyImage(filename).canvas(canvas_size), max(1, calls//50), results)
+        grey = GreyImage(filename).canvas(canvas_size)
+        for method in ['ordered', 'floyd']:
+            measure('dither %s %s' % (method, name), lambda: dither(grey, method), max(1, calls//50), results)
+        def setup():
+            make_paintbrush(filename, size, FakeSource()).brushes[0].writer.stop()
+        # the dithered levels are cached on disk, so time setting up both
+        # with the dithering and with the levels loaded back
+        cached = levels_cache(filename, canvas_size, 'floyd')
+        def uncache():
+            if os.path.exists(cached):
+                os.remove(cached)
+        measure('canvas setup %s' % name, setup, max(1, calls//50), results, uncache)
+        measure('canvas setup cached %s' % name, setup, max(1, calls//50), results)
+    
+    frames = blob_frames(20)
+    for detector in ['mask', 'numpy', 'numpy:4']:
+        d = make_detector(detector)
+        queue = list(frames)
+        def detect():
+            queue.append(queue.pop(0))
+            d.find(queue[0])
+        measure('detect %s' % detector, detect, calls, results)
+    
+    for size in sizes:
+        for speed in speeds:
+            for average_color in [False, True]:
+                if replay:
+                    camera = ReplaySource(replay, False)
+                else:
+                    camera = StrokeSource((int(size[0]*96), int(size[1]*96)), speed)
+                pb = make_paintbrush(filename, size, camera, average_color)
+                pb.painting = True
+                name = '%gx%g %s' % (size + (replay or 'speed %d' % speed,))
+                
+                def locate():
+                    pb.camera.update()
+                    pb.update_location()
+                    pb.brushes[0].reset()
+                def brush():
+                    if pb.brushes[0].point != None:
+                        pb.calculate_brush()
+                
+                if not average_color:
+                    measure('update_location %s' % name, locate, calls, results)
+                sampler = average_color and 'average_color' or 'sampler'
+                measure('calculate_brush %s %s' % (sampler, name), brush, calls, results, locate)
+                if not average_color:
+                    measure('send_command %s' % name, pb.send_command, calls, results)
+                pb.brushes[0].writer.stop()
+            if replay:
+                break
+    
+    # several heads share one detection pass and one canvas
+    size, speed = sizes[0], speeds[0]
+    for heads in [2, 4]:
+        camera = StrokeSource((int(size[0]*96), int(size[1]*96)), speed, heads)
+        pb = make_paintbrush(filename, size, camera, heads=heads)
+        pb.painting = True
+        def frame():
+            pb.camera.update()
+            pb.update_location()
+            for head, brush in enumerate(pb.brushes):
+                brush.reset()
+                if brush.point != None:
+                    pb.calculate_brush(head)
+                pb.send_command(head)
+        measure('locate, brush and send %d heads %gx%g speed %d' % ((heads,) + size + (speed,)), frame, calls, results)
+        for brush in pb.brushes:
+            brush.writer.stop()
+    
+    camera = [(15,140), (565,137), (29,447), (560,432)]
+    for n in [4, 100]:
+        for threshold in [None, 5.0]:
+            if n == 4 and threshold:
+                continue
+            t = LeastSquaresTransform((1024,768), threshold)
+            skew = PerspectiveTransform((1024,768))
+            for d, c in zip([(0,0), (1024,0), (0,768), (1024,768)], camera):
+                skew.add_point(d, c)
+            m = skew.calculate()
+            for i in range(n):
+                c = (random.uniform(0,640), random.uniform(0,480))
+                t.add_point(tuple(skew.apply(c, m)[0]), c)
+            name = 'PerspectiveTransform.calculate %d points' % n
+            if threshold:
+                name += ' ransac'
+            measure(name, t.calculate, max(1, calls//10), results)
+    
+    return results
+
+def compare(results, baseline, tolerance=0.1):
+    print ''
+    print '%-44s %9s %9s %7s' % ('benchmark', 'base ms', 'now ms', 'change')
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        before = baseline[name]['mean']
+        now = results[name]['mean']
+        change = now/before - 1 if before > 0 else 0.0
+        flag = ''
+        if change > tolerance:
+            flag = 'slower'
+        elif change < -tolerance:
+            flag = 'faster'
+        print '%-44s %9.3f %9.3f %+6.0f%% %s' % (name, before*1000, now*1000, change*100, flag)
+
+def usage():
+    print 'Times each stage of the paint loop headlessly, with made up or'
+    print 'recorded brush strokes, a fake serial port and no camera.'
+    print ''
+    print 'Options:'
+    print ' -h or --help            Displays this help text'
+    print ' -c or --calls           How many times to run each benchmark (200)'
+    print ' -s or --sizes           Canvas sizes in inches to try (6x8,12x16,24x32)'
+    print ' -v or --speeds          Brush speeds in dots per frame to try (2,8,32)'
+    print ' -y or --replay          Uses the strokes from a recorded session'
+    print ' -o or --save            Saves the results as a baseline to this file'
+    print ' -b or --baseline        Compares the results to a saved baseline'
+    print ''
+    print 'Usage:'
+    print 'python benchmark.py -o baseline.json monalisa.jpg'
+    print 'python benchmark.py -b baseline.json monalisa.jpg'
+
+if __name__ == '__main__':
+    calls = 200
+    sizes = [(6.0, 8.0), (12.0, 16.0), (24.0, 32.0)]
+    speeds = [2, 8, 32]
+    replay = None
+    save = None
+    baseline = None
+    
+    try:
+        opts,args = getopt.gnu_getopt(sys.argv[1:], "hc:s:v:y:o:b:", ["help", "calls=", "sizes=", "speeds=", "replay=", "save=", "baseline="])
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+    
+    for o,a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-c", "--calls"):
+            calls = int(a)
+        elif o in ("-s", "--sizes"):
+            sizes = [tuple([float(n) for n in s.split('x')]) for s in a.split(',')]
+        elif o in ("-v", "--speeds"):
+            speeds = [int(n) for n in a.split(',')]
+        elif o in ("-y", "--replay"):
+            replay = a
+        elif o in ("-o", "--save"):
+            save = a
+        elif o in ("-b", "--baseline"):
+            baseline = a
+    
+    if len(args) > 0:
+        filename = args[0]
+    else:
+        filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'monalisa.jpg')
+    
+    pygame.init()
+    results = run(filename, sizes, speeds, calls, replay)
+    
+    if baseline:
+        f = open(baseline)
+        compare(results, json.load(f))
+        f.close()
+    if save:
+        f = open(save, 'w')
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.close()
+        print 'Saved results to %s' % save
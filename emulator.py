@@ -0,0 +1,335 @@
+""" InkShield Firmware Emulator for the Semi-Automatic Paintbrush
+
+Copyright (c) 2011, Nirav Patel <http://eclecti.cc>
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+Stands in for an Arduino running paintbrush.pde at the other end of a
+pseudo terminal, so the paintbrush can be run and its serial protocols
+checked without any hardware.
+
+FirmwareEmulator - Parses commands from a pty the way the firmware does
+DamagedPort - Flips a bit in the next packet written through a serial port
+"""
+
+#!/usr/bin/env python
+
+import os
+import sys
+import tty
+import time
+import random
+import select
+import struct
+import getopt
+import threading
+import serial
+from paintbrush import SYNC, VERSION, ACK, NAK, MAX_FRAMES, crc8, SerialWriter
+
+# a packet is written all at once, so a gap this long means bytes were lost
+PACKET_GAP = 0.002
+
+class FirmwareEmulator:
+    """Parses commands from a pty the way the firmware does
+    
+    fired() -- Return every set of nozzle levels that took effect, and when
+    stop() -- Stop reading from the pty
+    
+    name is the pty to open as the serial port.  With legacy set, it acts
+    like the old firmware, which only knows the bare 6 byte commands and
+    never answers.  Otherwise it answers framed packets and plays out their
+    frames at their delays, dropping whatever is left of the last schedule
+    when a newer one arrives.  corrupt is the chance of flipping a bit in
+    each byte received, to stand in for a noisy line.  boot is how many
+    seconds everything received is dropped for, like an Arduino's
+    bootloader after the port is opened.  A packet that stops arriving for
+    PACKET_GAP seconds is dropped, like one whose count says it has more
+    frames than it can.
+    """
+    
+    def __init__(self, legacy=False, corrupt=0.0, boot=0.0):
+        self.master, self.slave = os.openpty()
+        # no echo or line editing, just bytes
+        tty.setraw(self.slave)
+        self.name = os.ttyname(self.slave)
+        self.legacy = legacy
+        self.corrupt = corrupt
+        self.boot = boot
+        self.started = time.time()
+        self.dropped = 0
+        
+        self.nozzles = [0]*12
+        self.command_index = 0
+        self.packet = None
+        self.last_byte = 0.0
+        self.last_seq = None
+        self.schedule = []
+        self.played = []
+        
+        self.packets = 0
+        self.acked = 0
+        self.rejected = 0
+        self.stale = 0
+        self.superseded = 0
+        self.broken = 0
+        self.commands = 0
+        self.lock = threading.Lock()
+        self.running = True
+        self.thread = threading.Thread(target=self.read)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def read(self):
+        """Parse everything that comes in, run by the reader thread"""
+        while self.running:
+            ready, w, x = select.select([self.master], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                data = bytearray(os.read(self.master, 4096))
+            except OSError:
+                return
+            now = time.time()
+            if now - self.started < self.boot:
+                # still in the bootloader, which doesn't pass anything on
+                self.dropped += len(data)
+                continue
+            self.lock.acquire()
+            for b in data:
+                if self.corrupt and random.random() < self.corrupt:
+                    b ^= 1 << random.randrange(8)
+                self.update_command(b, now)
+            self.lock.release()
+    
+    def update_command(self, incoming, now):
+        # waiting on the rest of a broken packet would swallow the ones after it
+        if self.packet is not None and now - self.last_byte > PACKET_GAP:
+            self.packet = None
+            self.broken += 1
+        self.last_byte = now
+        
+        if self.packet is not None:
+            self.packet.append(incoming)
+            if len(self.packet) == 3 and self.packet[2] > MAX_FRAMES:
+                # a bad count would have the body run on into the next packet
+                seq = self.packet[1]
+                self.packet = None
+                self.packets += 1
+                self.rejected += 1
+                self.reply(NAK, seq)
+                return
+            # version, seq and count, then 8 bytes a frame and the crc
+            if len(self.packet) >= 3:
+                count = min(self.packet[2], MAX_FRAMES)
+                if len(self.packet) == 3 + 8*count + 1:
+                    self.finish_packet(now)
+            return
+        
+        if incoming == SYNC and not self.legacy:
+            self.packet = bytearray()
+            return
+        # two high bits indicates the first byte in the range of 6
+        if (incoming & 0xC0) == 0xC0:
+            self.command_index = 0
+        # the commands are 3 bits for each nozzle
+        self.nozzles[self.command_index*2] = (incoming & 0x38) >> 3
+        self.nozzles[self.command_index*2 + 1] = (incoming & 0x07)
+        self.command_index += 1
+        if self.command_index > 5:
+            self.command_index = 0
+            self.commands += 1
+            self.play(now)
+            self.played.append((now, list(self.nozzles)))
+    
+    def finish_packet(self, now):
+        packet = self.packet
+        self.packet = None
+        self.packets += 1
+        version, seq, count = packet[0], packet[1], packet[2]
+        if crc8(packet[:-1]) != packet[-1] or version != VERSION or count > MAX_FRAMES:
+            self.rejected += 1
+            self.reply(NAK, seq)
+            return
+        self.acked += 1
+        self.reply(ACK, seq)
+        
+        if count == 0:
+            # a hello starts the sequence over
+            self.last_seq = None
+            return
+        if self.last_seq is not None and not 0 < (seq - self.last_seq) % 256 < 128:
+            # something newer has already been played
+            self.stale += 1
+            return
+        self.last_seq = seq
+        
+        self.play(now)
+        self.superseded += len(self.schedule)
+        self.schedule = []
+        for i in range(count):
+            frame = packet[3 + 8*i:3 + 8*i + 8]
+            delay = struct.unpack('<H', bytes(frame[:2]))[0] / 10000.0
+            levels = []
+            for b in frame[2:]:
+                levels.extend([(b & 0x38) >> 3, b & 0x07])
+            self.schedule.append((now + delay, levels))
+    
+    def play(self, now):
+        # every frame that is due has taken effect by now
+        while self.schedule and self.schedule[0][0] <= now:
+            when, levels = self.schedule.pop(0)
+            self.nozzles = levels
+            self.played.append((when, levels))
+    
+    def reply(self, kind, seq):
+        os.write(self.master, bytes(bytearray([kind, seq, VERSION])))
+    
+    def fired(self):
+        """Return every set of nozzle levels that took effect, and when"""
+        self.lock.acquire()
+        self.play(time.time())
+        played = list(self.played)
+        self.lock.release()
+        return played
+    
+    def stop(self):
+        """Stop reading from the pty"""
+        self.running = False
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+class DamagedPort:
+    """Flips a bit in the next packet written through a serial port
+    
+    damage(offset, bit) -- Flip a bit of the next packet, counting from SYNC
+    
+    Everything else goes straight through to port, so a SerialWriter can
+    write to it like a noisy line to the firmware.
+    """
+    
+    def __init__(self, port):
+        self.port = port
+        self.pending = None
+    
+    def damage(self, offset, bit):
+        """Flip a bit of the next packet, counting from SYNC"""
+        self.pending = (offset, bit)
+    
+    def write(self, data):
+        data = bytearray(data)
+        if self.pending is not None and data and data[0] == SYNC:
+            offset, bit = self.pending
+            data[offset] ^= bit
+            self.pending = None
+        return self.port.write(bytes(data))
+    
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+# the bytes of the all-off packet ending a stroke that the check damages,
+# counting from SYNC, and the bit flipped in each
+DAMAGE = [('a level', 6, 0x20), ('the frame count', 3, 0x04)]
+
+def check(limit=0.2):
+    """Return whether the nozzles stop when the end of a stroke is damaged
+    
+    A stroke is painted through a pty to the emulator, and then the packet
+    turning the nozzles off is damaged in each way in DAMAGE, while the
+    same off schedule keeps being sent like the paintbrush does.  The
+    nozzles have to stop within limit seconds each time.
+    """
+    passed = True
+    for name, offset, bit in DAMAGE:
+        emulator = FirmwareEmulator()
+        port = DamagedPort(serial.Serial(emulator.name, 115200, timeout=200, writeTimeout=0.5))
+        writer = SerialWriter(port, protocol='framed')
+        end = time.time() + 0.3
+        while time.time() < end:
+            writer.send([(0.0, [4]*12)])
+            time.sleep(1/30.0)
+        port.damage(offset, bit)
+        stopped = time.time()
+        while time.time() < stopped + 2.0:
+            writer.send([(0.0, [0]*12)])
+            time.sleep(1/30.0)
+        writer.stop()
+        port.close()
+        emulator.stop()
+        
+        off = [when for when, levels in emulator.played if when >= stopped and not any(levels)]
+        if off and off[0] - stopped < limit:
+            print 'Damaged %s: the nozzles stopped %.3fs later' % (name, off[0] - stopped)
+        elif off:
+            print 'Damaged %s: the nozzles only stopped %.3fs later' % (name, off[0] - stopped)
+            passed = False
+        else:
+            print 'Damaged %s: the nozzles never stopped' % name
+            passed = False
+    return passed
+
+def usage():
+    print 'Opens a pty that acts like an Arduino running paintbrush.pde, for'
+    print 'running the paintbrush without an InkShield.'
+    print ''
+    print 'Options:'
+    print ' -h or --help            Displays this help text'
+    print ' -l or --legacy          Acts like the old firmware, without framed packets'
+    print ' -c or --corrupt         Flips a bit in this fraction of the bytes received (0)'
+    print ' -b or --boot            Ignores everything for this many seconds after starting (0)'
+    print ' -t or --test            Checks the nozzles stop when the end of a stroke is damaged'
+    print ''
+    print 'Usage:'
+    print 'python emulator.py'
+    print 'python paintbrush.py -p /dev/pts/N monalisa.jpg'
+
+if __name__ == '__main__':
+    legacy = False
+    corrupt = 0.0
+    boot = 0.0
+    test = False
+    
+    try:
+        opts,args = getopt.gnu_getopt(sys.argv[1:], "hlc:b:t", ["help", "legacy", "corrupt=", "boot=", "test"])
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+    
+    for o,a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-l", "--legacy"):
+            legacy = True
+        elif o in ("-c", "--corrupt"):
+            corrupt = float(a)
+        elif o in ("-b", "--boot"):
+            boot = float(a)
+        elif o in ("-t", "--test"):
+            test = True
+    
+    if test:
+        sys.exit(not check())
+    
+    emulator = FirmwareEmulator(legacy, corrupt, boot)
+    print 'Emulating the firmware on %s, press ctrl-c to stop' % emulator.name
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    emulator.stop()
+    print 'Played %d sets of levels from %d packets and %d legacy commands' % (len(emulator.played), emulator.packets, emulator.commands)
+    print '%d packets rejected, %d stale, %d frames superseded before playing' % (emulator.rejected, emulator.stale, emulator.superseded)
+    print '%d packets broken off partway' % emulator.broken
@@ -22,10 +22,14 @@ split into classes with the intent of being easy to pull apart and use
 elsewhere.
 
 FakeSource - A fake camera for testing purposes
+MaskDetector - Finds IR blobs in an image using pygame masks
+NumpyDetector - Finds IR blobs in an image with sub-pixel accuracy using numpy
+PointTracker - Keeps the identity of several IR blobs from frame to frame
 IRCamera - Finds points using a pygame-supported IR Camera
 WiiRemote - Finds points using a Wii Remote (unfinished)
 PerspectiveTransform - Calculates a homography using four corner points
 LeastSquaresTransform - Calculates a homography using four or more random points
+SyntheticSource - A fake camera that watches the display through a known homography
 Homography - Uses pygame to interactively calculate a camera-projector homography 
 """
 
@@ -35,7 +39,9 @@ __author__ = 'Nirav Patel'
 #!/usr/bin/env python
 
 import sys
+import time
 import random
+import threading
 import getopt
 import numpy
 from numpy import linalg
@@ -49,11 +55,31 @@ except ImportError:
 from pygame.locals import *
 
 class FakeSource:
+    # seconds between frames from the source, when it knows
+    interval = None
+    # whether frames come at the source's own pace, not as fast as they are read
+    paced = False
+    
     def __init__(self):
         self.count = 0
+        self.timestamp = None
+        self.snapshot = pygame.surface.Surface((10,10),0)
     
     def update(self):
-        return pygame.surface.Surface((10,10),0)
+        return self.snapshot
+        
+    def preview(self):
+        # what the source last saw, ready to be shown
+        return self.snapshot
+        
+    def luminance(self):
+        # the brightness of what the source last saw as an [x, y] view, which
+        # keeps the surface locked until it is deleted
+        return pygame.surfarray.pixels_red(self.snapshot)
+        
+    def wait(self, timeout):
+        # a made up frame is always ready
+        return True
         
     def get_point(self):
         ret = (0,0)
@@ -67,43 +93,547 @@ class FakeSource:
             ret = (560,432)
         self.count += 1
         return ret
+        
+    def get_points(self, count):
+        # sources that can only see one blob have only one point to give
+        point = self.get_point()
+        if point:
+            return [point]
+        return []
+        
+    def stop(self):
+        pass
+
+class MaskDetector:
+    """Finds IR blobs in an image using pygame masks
+    
+    find(surface) -- Return the centroid and bounds of the largest IR blob
+    find_all(surface, count) -- Return the centroids and bounds of the largest IR blobs
+    use_luminance() -- Only look at the first channel of surfaces, like YUV ones
+    """
+    
+    def __init__(self, minimum=100):
+        self.minimum = minimum
+        self.color = (255,255,255)
+        self.tolerance = (64,64,64)
+        
+    def use_luminance(self):
+        """Only look at the first channel of surfaces, like YUV ones"""
+        # any colour at all passes the other two channels
+        self.color = (255,128,128)
+        self.tolerance = (64,255,255)
+        
+    def find(self, surface):
+        """Return the centroid and bounds of the largest IR blob"""
+        mask = pygame.mask.from_threshold(surface, self.color, self.tolerance)
+        cc = mask.connected_component()
+        # find the center of the dot, assuming its big enough to not be noise
+        if cc.count() < self.minimum:
+            return None, None
+        return cc.centroid(), cc.get_bounding_rects()[0]
+        
+    def find_all(self, surface, count):
+        """Return the centroids and bounds of the largest IR blobs"""
+        mask = pygame.mask.from_threshold(surface, self.color, self.tolerance)
+        blobs = mask.connected_components(self.minimum)
+        blobs.sort(key=lambda cc: cc.count(), reverse=True)
+        return [(cc.centroid(), cc.get_bounding_rects()[0]) for cc in blobs[:count]]
+
+class NumpyDetector(MaskDetector):
+    """Finds IR blobs in an image with sub-pixel accuracy using numpy
+    
+    find(surface) -- Return the centroid and bounds of the largest IR blob
+    find_all(surface, count) -- Return the centroids and bounds of the largest IR blobs
+    find_luminance(pixels) -- Return the centroid and bounds of the largest IR blob
+    find_all_luminance(pixels, count) -- Return the centroids and bounds of the largest IR blobs
+    use_luminance() -- Nothing to do, only the first channel is ever used
+    
+    Works directly on the red channel of the surface's pixels, or on any
+    [x, y] array of brightness, like a camera's luminance plane.  Each blob is
+    grown to its bounding box in a view decimated by 1, 2 or 4, the one with
+    the most lit pixels there is kept, and then its brightness weighted
+    centroid is taken at full resolution.
+    """
+    
+    def __init__(self, minimum=100, decimate=2, threshold=192):
+        self.minimum = minimum
+        self.decimate = decimate
+        # the same cutoff as the mask's (255,255,255)+-64 on one channel
+        self.threshold = threshold
+        
+    def find(self, surface):
+        """Return the centroid and bounds of the largest IR blob"""
+        pixels = pygame.surfarray.pixels_red(surface)
+        try:
+            return self.search(pixels)
+        finally:
+            # the view keeps the surface locked until it is gone
+            del pixels
+        
+    def use_luminance(self):
+        """Nothing to do, only the first channel is ever used"""
+        pass
+        
+    def find_luminance(self, pixels):
+        """Return the centroid and bounds of the largest IR blob"""
+        return self.search(pixels)
+        
+    def find_all(self, surface, count):
+        """Return the centroids and bounds of the largest IR blobs"""
+        return self.find_all_luminance(pygame.surfarray.array_red(surface), count)
+        
+    def find_all_luminance(self, pixels, count):
+        """Return the centroids and bounds of the largest IR blobs"""
+        # each blob is blacked out once found, so work on a copy
+        pixels = numpy.array(pixels)
+        found = []
+        while len(found) < count:
+            centroid, bounds = self.search(pixels)
+            if not centroid:
+                break
+            found.append((centroid, bounds))
+            pixels[bounds.left:bounds.right, bounds.top:bounds.bottom] = 0
+        return found
+        
+    def search(self, pixels):
+        d = self.decimate
+        hits = pixels[::d, ::d] >= self.threshold
+        if hits.sum()*d*d < self.minimum/2:
+            return None, None
+        
+        # start from the coarse pixel with the most hits around it, which
+        # is inside a blob rather than on a stray hot pixel
+        k = max(1, 8//d)
+        sat = numpy.zeros((hits.shape[0]+1, hits.shape[1]+1), numpy.int32)
+        sat[1:, 1:] = hits.cumsum(0).cumsum(1)
+        density = sat[k:, k:] - sat[:-k, k:] - sat[k:, :-k] + sat[:-k, :-k]
+        sx, sy = numpy.unravel_index(density.argmax(), density.shape)
+        box = hits[sx:sx+k, sy:sy+k]
+        sx += box.any(1).argmax()
+        sy += box.any(0).argmax()
+        
+        # any blob big enough fills the window, so grow a box around every
+        # one and keep the box with the most hits.  once fewer hits are left
+        # outside the boxes than the best has, nothing left can beat it
+        remaining = hits.copy()
+        left = int(remaining.sum())
+        most = 0
+        while left > most:
+            x0, x1, y0, y1 = self.grow(hits, sx, sy)
+            count = int(hits[x0:x1+1, y0:y1+1].sum())
+            if count > most:
+                most = count
+                best = (x0, x1, y0, y1)
+            left -= int(remaining[x0:x1+1, y0:y1+1].sum())
+            remaining[x0:x1+1, y0:y1+1] = False
+            sx, sy = numpy.unravel_index(remaining.argmax(), remaining.shape)
+        x0, x1, y0, y1 = best
+        
+        # refine at full resolution, including the pixels skipped over
+        x0, y0 = max(0, x0*d - d), max(0, y0*d - d)
+        x1, y1 = x1*d + 2*d, y1*d + 2*d
+        window = pixels[x0:x1, y0:y1].astype(numpy.int32)
+        weights = window - (self.threshold - 1)
+        weights[weights < 0] = 0
+        lit = weights > 0
+        if lit.sum() < self.minimum:
+            return None, None
+        
+        total = float(weights.sum())
+        xs = numpy.arange(window.shape[0])
+        ys = numpy.arange(window.shape[1])
+        cx = x0 + numpy.dot(weights.sum(1), xs)/total
+        cy = y0 + numpy.dot(weights.sum(0), ys)/total
+        cols = numpy.flatnonzero(lit.any(1))
+        rows = numpy.flatnonzero(lit.any(0))
+        bounds = pygame.Rect(cols[0], rows[0], cols[-1]-cols[0]+1, rows[-1]-rows[0]+1)
+        bounds.move_ip(x0, y0)
+        return (cx, cy), bounds
+        
+    def grow(self, hits, sx, sy):
+        # grow a box around a hit until no hits touch its edges
+        w, h = hits.shape
+        x0 = x1 = sx
+        y0 = y1 = sy
+        grown = True
+        while grown:
+            grown = False
+            if x0 > 0 and hits[x0-1, y0:y1+1].any():
+                x0 -= 1
+                grown = True
+            if x1 < w-1 and hits[x1+1, y0:y1+1].any():
+                x1 += 1
+                grown = True
+            if y0 > 0 and hits[x0:x1+1, y0-1].any():
+                y0 -= 1
+                grown = True
+            if y1 < h-1 and hits[x0:x1+1, y1+1].any():
+                y1 += 1
+                grown = True
+        return x0, x1, y0, y1
+
+class PointTracker:
+    """Keeps the identity of several IR blobs from frame to frame
+    
+    update(points) -- Return the points in order of identity
+    
+    Each identity is matched to the nearest point to where it is expected,
+    the closest pairs first, as long as that is within distance.  Points
+    that are left over take the free identities from left to right, and
+    an identity is given up after missing coast frames in a row.
+    """
+    
+    def __init__(self, count, distance=48, coast=3):
+        self.count = count
+        self.distance = distance
+        self.coast = coast
+        self.last = [None]*count
+        self.velocity = [(0, 0)]*count
+        self.missed = [0]*count
+        
+    def update(self, points):
+        """Return the points in order of identity, None where one wasn't seen"""
+        expected = []
+        for last, v in zip(self.last, self.velocity):
+            if last is None:
+                expected.append(None)
+            else:
+                expected.append((last[0] + v[0], last[1] + v[1]))
+        
+        pairs = []
+        for i, e in enumerate(expected):
+            if e is None:
+                continue
+            for j, p in enumerate(points):
+                d = (p[0]-e[0])**2 + (p[1]-e[1])**2
+                if d <= self.distance**2:
+                    pairs.append((d, i, j))
+        pairs.sort()
+        
+        matched = [None]*self.count
+        used = set()
+        for d, i, j in pairs:
+            if matched[i] is None and j not in used:
+                matched[i] = points[j]
+                used.add(j)
+        
+        free = [i for i in range(self.count) if matched[i] is None and self.last[i] is None]
+        rest = sorted([p for j, p in enumerate(points) if j not in used])
+        for i, p in zip(free, rest):
+            matched[i] = p
+        
+        for i in range(self.count):
+            p = matched[i]
+            if p is not None:
+                if self.last[i] is not None:
+                    self.velocity[i] = (p[0] - self.last[i][0], p[1] - self.last[i][1])
+                self.last[i] = p
+                self.missed[i] = 0
+            elif self.last[i] is not None:
+                self.missed[i] += 1
+                if self.missed[i] > self.coast:
+                    self.last[i] = None
+                    self.velocity[i] = (0, 0)
+        return matched
+
+def make_detector(name):
+    """Return a blob detector by name, 'mask' or 'numpy' with an optional
+    decimation like 'numpy:4', or None to leave it to the source"""
+    if name is None:
+        return None
+    if name == 'mask':
+        return MaskDetector()
+    elif name.startswith('numpy'):
+        parts = name.split(':')
+        if len(parts) > 1:
+            return NumpyDetector(decimate=int(parts[1]))
+        return NumpyDetector()
+    raise ValueError('Unknown detector %s, use mask or numpy' % name)
 
 class IRCamera(FakeSource):
     """Interface an IR Camera in pygame
     
     update() -- Read in and return a new image from the camera
+    wait(timeout) -- Wait up to timeout seconds for a frame not yet read
+    luminance() -- Return the brightness of the image as an [x, y] view
+    preview() -- Return the image, converted for showing on screen
     get_point() -- Return the centroid of the largest IR blob found
+    get_points(count) -- Return the centroids of the largest IR blobs found
+    stop() -- Stop the capture thread and the camera
+    
+    With threaded set, a background thread keeps a small ring of frames
+    filled, and update() returns the newest complete one without waiting.
+    timestamp is the capture time of the current frame, and dropped counts
+    frames that were replaced before anything read them.
+    
+    detector picks how blobs are found, a MaskDetector unless given.
+    
+    With tracking set, get_point() only searches a window around where the
+    blob is expected to be, sized from how fast it has been moving, and
+    falls back to the whole frame when it isn't found there.  roi_hits and
+    full_scans count how often each search was used.
+    
+    mode is how frames come from the camera.  RGB is converted by the
+    camera.  YUV skips that, and the luminance is in the red channel.  raw
+    takes the camera's YUYV bytes as they are, which needs a detector that
+    can read the luminance plane, like NumpyDetector.  Only the luminance
+    is looked at to find blobs, with no copy in YUV or raw, and preview()
+    only converts a frame to grey when it is actually shown.
+    
+    interval is the time between frames from the camera, smoothed.  Without
+    a thread, frames only come as often as they are read, so it is only
+    measured between reads that each followed a wait(), which is how a
+    reader keeping up with the camera goes around.
     """
     
-    def __init__(self):
+    paced = True
+    
+    def __init__(self, threaded=False, frames=3, tracking=False, margin=24, detector=None, mode='RGB'):
         pygame.camera.init()
         
         # start the camera and find its resolution
         clist = pygame.camera.list_cameras()
         if len(clist) == 0:
             raise IOError('No cameras found.  The IRCamera class needs a camera supported by Pygame')
+        if mode not in ('RGB', 'YUV', 'raw'):
+            raise ValueError('Unknown capture mode %s, use RGB, YUV or raw' % mode)
+        self.mode = mode
         self.resolution = (640,480)
-        self.camera = pygame.camera.Camera(clist[0], self.resolution, "RGB")
+        # raw frames skip the conversion whatever format is asked for
+        self.camera = pygame.camera.Camera(clist[0], self.resolution, mode == 'RGB' and "RGB" or "YUV")
         self.camera.start()
         # use the actual resolution, may or may not be the VGA asked for
         self.resolution = self.camera.get_size()
         self.snapshot = pygame.surface.Surface(self.resolution, 0)
+        self.raw = None
+        self.shown = None
+        self.converted = False
+        self.timestamp = None
+        self.last_stamp = None
+        self.interval = None
+        # whether the reader waited for the frame it reads next
+        self.keeping_up = False
+        self.dropped = 0
+        
+        if detector is None:
+            if mode == 'raw':
+                detector = NumpyDetector()
+            else:
+                detector = MaskDetector()
+        if mode == 'raw' and not hasattr(detector, 'find_luminance'):
+            raise ValueError('Raw capture needs a detector that reads luminance, like numpy')
+        if mode != 'RGB':
+            detector.use_luminance()
+        self.detector = detector
+        self.tracking = tracking
+        self.margin = margin
+        self.last_point = None
+        self.velocity = (0, 0)
+        self.roi_hits = 0
+        self.full_scans = 0
+        
+        self.threaded = threaded
+        if threaded:
+            # the reader holds one frame and the newest waits in another,
+            # so three is the fewest that never stalls the capture thread
+            frames = max(3, frames)
+            self.ring = [pygame.surface.Surface(self.resolution, 0) for i in range(frames)]
+            self.stamps = [None]*frames
+            self.newest = None
+            self.held = None
+            self.unread = False
+            # a condition, so the reader can wait for the next frame
+            self.lock = threading.Condition()
+            self.running = True
+            self.thread = threading.Thread(target=self.capture)
+            self.thread.daemon = True
+            self.thread.start()
+        
+    def capture(self):
+        """Keep the ring filled with frames, run by the capture thread"""
+        while self.running:
+            self.lock.acquire()
+            slot = [i for i in range(len(self.ring)) if i not in (self.newest, self.held)][0]
+            self.lock.release()
+            
+            # nobody else touches a slot that is neither newest nor held
+            if self.mode == 'raw':
+                self.ring[slot] = self.camera.get_raw()
+            else:
+                self.ring[slot] = self.camera.get_image(self.ring[slot])
+            stamp = time.time()
+            
+            self.lock.acquire()
+            if self.unread:
+                self.dropped += 1
+            self.newest = slot
+            self.stamps[slot] = stamp
+            self.unread = True
+            self.measure(stamp)
+            self.lock.notify()
+            self.lock.release()
+        
+    def measure(self, stamp):
+        # smooth the time between frames, so one late frame doesn't count much
+        if self.last_stamp is not None:
+            gap = stamp - self.last_stamp
+            if self.interval is None:
+                self.interval = gap
+            else:
+                self.interval += (gap - self.interval)*0.1
+        self.last_stamp = stamp
+        
+    def wait(self, timeout):
+        """Wait up to timeout seconds for a frame not yet read"""
+        if not self.threaded:
+            # reading blocks until the camera has a frame anyway
+            self.keeping_up = True
+            return True
+        self.lock.acquire()
+        if not self.unread:
+            self.lock.wait(timeout)
+        unread = self.unread
+        self.lock.release()
+        return unread
         
     def update(self):
         """Read in and return a new image from the camera"""
-        self.snapshot = self.camera.get_image(self.snapshot)
+        self.converted = False
+        if not self.threaded:
+            if self.mode == 'raw':
+                self.raw = self.camera.get_raw()
+            else:
+                self.snapshot = self.camera.get_image(self.snapshot)
+            self.timestamp = time.time()
+            if self.keeping_up:
+                self.measure(self.timestamp)
+            else:
+                # the gap to a read the reader came back to late is how long
+                # it was away, not how fast the camera is
+                self.last_stamp = None
+            self.keeping_up = False
+            return self.snapshot
+        
+        # hand back the newest complete frame, or the last one again if
+        # the camera hasn't delivered anything since
+        self.lock.acquire()
+        if self.newest is not None:
+            self.held = self.newest
+            self.unread = False
+        held = self.held
+        self.lock.release()
+        
+        if held is not None:
+            if self.mode == 'raw':
+                self.raw = self.ring[held]
+            else:
+                self.snapshot = self.ring[held]
+            self.timestamp = self.stamps[held]
         return self.snapshot
         
+    def luminance(self):
+        """Return the brightness of the image as an [x, y] view
+        
+        Nothing is copied, and a view of a surface keeps it locked until
+        the view is deleted.
+        """
+        if self.mode != 'raw':
+            # IR filtered RGB is grey anyway, and YUV keeps luminance in red
+            return pygame.surfarray.pixels_red(self.snapshot)
+        w, h = self.resolution
+        if self.raw is None:
+            return numpy.zeros((w, h), numpy.uint8)
+        if len(self.raw) != w*h*2:
+            raise IOError('Raw frames from this camera are not YUYV, use the YUV mode instead')
+        # YUYV, so every other byte is the luminance of the next pixel
+        return numpy.frombuffer(self.raw, numpy.uint8)[::2].reshape(h, w).T
+        
+    def preview(self):
+        """Return the image, converted for showing on screen"""
+        if self.mode == 'RGB':
+            return self.snapshot
+        if not self.converted:
+            # only done when something is going to be shown
+            if self.shown is None:
+                self.shown = pygame.surface.Surface(self.resolution, 0, 32)
+            pixels = pygame.surfarray.pixels3d(self.shown)
+            luminance = self.luminance()
+            pixels[...] = luminance[:, :, numpy.newaxis]
+            del luminance
+            del pixels
+            self.converted = True
+        return self.shown
+        
+    def detect(self, window=None):
+        # the luminance plane is enough for detectors that can read it
+        if hasattr(self.detector, 'find_luminance'):
+            luminance = self.luminance()
+            if window:
+                luminance = luminance[window.left:window.right, window.top:window.bottom]
+            try:
+                return self.detector.find_luminance(luminance)
+            finally:
+                del luminance
+        if window:
+            return self.detector.find(self.snapshot.subsurface(window))
+        return self.detector.find(self.snapshot)
+        
     def get_point(self):
         """Return the centroid of the largest IR blob found"""
-        mask = pygame.mask.from_threshold(self.snapshot, (255,255,255), (64,64,64))
-        cc = mask.connected_component()
-        # find the center of the dot, assuming its big enough to not be noise
-        if cc.count() < 100:
-            return None
-        centroid = cc.centroid()
+        centroid = None
+        if self.tracking and self.last_point:
+            # search where the blob should be if it kept moving the same way
+            rx = int(self.margin + 2*abs(self.velocity[0]))
+            ry = int(self.margin + 2*abs(self.velocity[1]))
+            window = pygame.Rect(0, 0, rx*2, ry*2)
+            window.center = (int(self.last_point[0] + self.velocity[0]), int(self.last_point[1] + self.velocity[1]))
+            frame = pygame.Rect((0, 0), self.resolution)
+            window = window.clip(frame)
+            if window.width and window.height:
+                centroid, bounds = self.detect(window)
+            # a blob touching an edge of the window that isn't an edge of
+            # the frame may have been cut off, so look at the whole frame
+            if centroid:
+                if (bounds.left == 0 and window.left > frame.left) or \
+                   (bounds.top == 0 and window.top > frame.top) or \
+                   (bounds.right == window.width and window.right < frame.right) or \
+                   (bounds.bottom == window.height and window.bottom < frame.bottom):
+                    centroid = None
+                else:
+                    centroid = (centroid[0] + window.left, centroid[1] + window.top)
+                    self.roi_hits += 1
+        
+        if not centroid:
+            centroid, bounds = self.detect()
+            self.full_scans += 1
+        
+        if self.tracking:
+            if centroid and self.last_point:
+                self.velocity = (centroid[0] - self.last_point[0], centroid[1] - self.last_point[1])
+            else:
+                self.velocity = (0, 0)
+            self.last_point = centroid
         return centroid
         
+    def get_points(self, count):
+        """Return the centroids of the largest IR blobs found"""
+        # several blobs can be anywhere, so this always looks at the whole frame
+        self.full_scans += 1
+        if hasattr(self.detector, 'find_all_luminance'):
+            luminance = self.luminance()
+            found = self.detector.find_all_luminance(luminance, count)
+            del luminance
+        else:
+            found = self.detector.find_all(self.snapshot, count)
+        return [centroid for centroid, bounds in found]
+        
+    def stop(self):
+        """Stop the capture thread and the camera"""
+        if self.threaded and self.running:
+            self.running = False
+            self.thread.join()
+        self.camera.stop()
+        
 class WiiRemote(FakeSource):
     """Wii Remote interface not supported until I can find a good library.
     """
@@ -117,21 +647,42 @@ class WiiRemote(FakeSource):
     def get_point(self):
         pass
 
+def normalize(points):
+    """Returns the points moved to be centered on the origin with an average
+    distance of sqrt(2) from it, and the matrix that does that"""
+    center = points.mean(0)
+    scale = numpy.sqrt(((points - center)**2).sum(1)).mean()
+    scale = numpy.sqrt(2)/scale if scale > 0 else 1.0
+    T = numpy.array([[scale, 0, -scale*center[0]],
+                     [0, scale, -scale*center[1]],
+                     [0, 0, 1]])
+    return (points - center)*scale, T
+
 class PerspectiveTransform:
     """Calculates the perspective transform using 4 corner points
     
     generate_point() -- Generates the next screen point to use
     add_point(display, camera) -- Adds a matched pair of points
     calculate() -- Calculates the homography if there are 4 point pairs
+    apply(points) -- Maps an Nx2 array of camera points to display points
+    errors() -- Returns the reprojection error of each point pair
+    
+    With threshold set and more than 4 pairs, calculate() uses RANSAC to
+    leave out pairs that reproject further than threshold display pixels,
+    so one bad detection can't pull the whole homography off.
     """
     
-    def __init__(self, resolution):
+    def __init__(self, resolution, threshold=None, iterations=200):
         self.resolution = resolution
     
         # store the coordinates of the displayed and captured points
         self.display_points = []
         self.camera_points = []
         self.points = 4
+        self.matrix = None
+        self.threshold = threshold
+        self.iterations = iterations
+        self.inliers = None
         
     def generate_point(self):
         """Generates the next screen point to use"""
@@ -165,25 +716,86 @@ class PerspectiveTransform:
             print 'Need 4 points to calculate transform'
             return None
         
+        camera = numpy.asarray(self.camera_points, numpy.float64)
+        display = numpy.asarray(self.display_points, numpy.float64)
+        self.inliers = numpy.ones(n, bool)
+        if self.threshold is not None and n > self.points:
+            self.inliers = self.ransac(camera, display)
+        
+        self.matrix = self.solve(camera[self.inliers], display[self.inliers])
+        return self.matrix
+        
+    def ransac(self, camera, display):
+        # fit to random minimal sets and keep whichever agrees with the most
+        # pairs, preferring the smallest total error among ties
+        best = None
+        best_score = (0, 0.0)
+        for i in range(self.iterations):
+            sample = numpy.random.permutation(len(camera))[:self.points]
+            matrix = self.solve(camera[sample], display[sample])
+            if matrix is None:
+                continue
+            err = self.errors(matrix, camera, display)
+            inliers = err < self.threshold
+            score = (inliers.sum(), -err[inliers].sum())
+            if best is None or score > best_score:
+                best = inliers
+                best_score = score
+        
+        if best is None or best.sum() < self.points:
+            return numpy.ones(len(camera), bool)
+        return best
+        
+    def solve(self, camera, display):
         # This calculation is from the paper, A Plane Measuring Device
         # by A. Criminisi, I. Reid, A. Zisserman.  For more details, see:
         # http://www.robots.ox.ac.uk/~vgg/presentations/bmvc97/criminispaper/
+        # The points are normalized first as suggested by R. Hartley in
+        # In Defense of the Eight-Point Algorithm, to keep it well conditioned
+        c, Tc = normalize(camera)
+        d, Td = normalize(display)
+        x, y = c[:, 0], c[:, 1]
+        u, v = d[:, 0], d[:, 1]
+        
+        n = len(c)
         A = numpy.zeros((n*2,8))
-        B = numpy.zeros((n*2,1))
-        for i in range(0,n):
-            A[2*i][0:2] = self.camera_points[i]
-            A[2*i][2] = 1
-            A[2*i][6] = -self.camera_points[i][0]*self.display_points[i][0]
-            A[2*i][7] = -self.camera_points[i][1]*self.display_points[i][0]
-            A[2*i+1][3:5] = self.camera_points[i]
-            A[2*i+1][5] = 1
-            A[2*i+1][6] = -self.camera_points[i][0]*self.display_points[i][1]
-            A[2*i+1][7] = -self.camera_points[i][1]*self.display_points[i][1]
-            B[2*i] = self.display_points[i][0]
-            B[2*i+1] = self.display_points[i][1]
+        A[0::2, 0] = x
+        A[0::2, 1] = y
+        A[0::2, 2] = 1
+        A[0::2, 6] = -x*u
+        A[0::2, 7] = -y*u
+        A[1::2, 3] = x
+        A[1::2, 4] = y
+        A[1::2, 5] = 1
+        A[1::2, 6] = -x*v
+        A[1::2, 7] = -y*v
+        B = numpy.empty(n*2)
+        B[0::2] = u
+        B[1::2] = v
         
         X = linalg.lstsq(A,B)
-        return numpy.reshape(numpy.vstack((X[0],[1])),(3,3))
+        H = numpy.reshape(numpy.append(X[0],1),(3,3))
+        # undo the normalization on both sides
+        H = numpy.dot(linalg.inv(Td), numpy.dot(H, Tc))
+        if abs(H[2,2]) < 1e-12:
+            return None
+        return H/H[2,2]
+        
+    def apply(self, points, matrix=None):
+        """Maps an Nx2 array of camera points to display points"""
+        if matrix is None:
+            matrix = self.matrix
+        points = numpy.asarray(points, numpy.float64).reshape(-1, 2)
+        p = numpy.dot(points, matrix[:, :2].T) + matrix[:, 2]
+        return p[:, :2] / p[:, 2:]
+        
+    def errors(self, matrix=None, camera=None, display=None):
+        """Returns the reprojection error of each point pair"""
+        if camera is None:
+            camera = numpy.asarray(self.camera_points, numpy.float64)
+            display = numpy.asarray(self.display_points, numpy.float64)
+        p = self.apply(camera, matrix)
+        return numpy.sqrt(((p - display)**2).sum(1))
     
 class LeastSquaresTransform(PerspectiveTransform):
     """ Uses 4+ random points in the screen to calculate the transform
@@ -198,6 +810,58 @@ class LeastSquaresTransform(PerspectiveTransform):
         
         return len(self.display_points) < self.points
         
+class SyntheticSource(FakeSource):
+    """A fake camera that watches the display through a known homography
+    
+    update() -- Render and return what the camera would see of the display
+    get_point() -- Return the centroid of the largest IR blob found
+    get_points(count) -- Return the centroids of the largest IR blobs found
+    
+    matrix maps camera points to display points, like the homography that
+    calibrating against this source should come up with.
+    """
+    
+    def __init__(self, matrix, resolution=(640,480), detector=None):
+        self.matrix = matrix
+        self.resolution = resolution
+        self.snapshot = pygame.surface.Surface(resolution, 0, 32)
+        self.timestamp = None
+        if detector is None:
+            detector = MaskDetector()
+        self.detector = detector
+        self.lookup = None
+        
+    def update(self):
+        """Render and return what the camera would see of the display"""
+        display = pygame.display.get_surface()
+        if self.lookup is None:
+            # find the display pixel each camera pixel sees, once
+            w, h = self.resolution
+            grid = numpy.mgrid[0:w, 0:h].reshape(2, -1).T
+            p = PerspectiveTransform(display.get_size()).apply(grid, self.matrix)
+            p = numpy.rint(p).astype(numpy.intp)
+            dw, dh = display.get_size()
+            inside = (p[:, 0] >= 0) & (p[:, 0] < dw) & (p[:, 1] >= 0) & (p[:, 1] < dh)
+            self.lookup = (grid[inside, 0], grid[inside, 1], p[inside, 0], p[inside, 1])
+        
+        cx, cy, dx, dy = self.lookup
+        seen = pygame.surfarray.array3d(display)
+        pixels = pygame.surfarray.pixels3d(self.snapshot)
+        pixels[...] = 0
+        pixels[cx, cy] = seen[dx, dy]
+        del pixels
+        self.timestamp = time.time()
+        return self.snapshot
+        
+    def get_point(self):
+        """Return the centroid of the largest IR blob found"""
+        centroid, bounds = self.detector.find(self.snapshot)
+        return centroid
+        
+    def get_points(self, count):
+        """Return the centroids of the largest IR blobs found"""
+        return [centroid for centroid, bounds in self.detector.find_all(self.snapshot, count)]
+
 class Homography:
     def __init__(self, resolution, algorithm, source):
         pygame.mouse.set_visible(False)
@@ -220,7 +884,8 @@ class Homography:
         rects = []
         
         # update the source display (ir image)
-        surf = self.source.update()
+        self.source.update()
+        surf = self.source.preview()
         rects.append(self.display.blit(surf, (0,0)))
         pygame.draw.rect(self.display, (255,0,0), rects[0], 1)
         
@@ -270,6 +935,51 @@ class Homography:
         homography = self.algorithm.calculate()
         return homography
         
+    def targets(self, grid, margin=0.05):
+        # spread the targets evenly over the display, a little in from the edges
+        w, h = self.display_res
+        targets = []
+        for j in range(grid[1]):
+            for i in range(grid[0]):
+                x = margin + (1 - 2*margin)*i/max(1, grid[0]-1)
+                y = margin + (1 - 2*margin)*j/max(1, grid[1]-1)
+                targets.append((int(x*w), int(y*h)))
+        return targets
+        
+    def run_automatic(self, grid=(8,6), timeout=1.0, settle=0.1, radius=20):
+        """Shows a grid of bright targets one at a time and finds each with
+        the source, without anyone having to hold an LED"""
+        found = 0
+        targets = self.targets(grid)
+        for target in targets:
+            self.display.fill((0,0,0))
+            pygame.draw.circle(self.display, (255,255,255), target, radius)
+            pygame.display.flip()
+            shown = time.time()
+            
+            cam_point = None
+            while cam_point is None and time.time() - shown < timeout:
+                self.source.update()
+                # frames from before the target was up would find the last one
+                if self.source.timestamp is not None and self.source.timestamp < shown + settle:
+                    continue
+                cam_point = self.source.get_point()
+            
+            if cam_point:
+                self.algorithm.display_points.append(target)
+                self.algorithm.camera_points.append(cam_point)
+                found += 1
+            else:
+                print 'No point found for target %s' % repr(target)
+            
+            for e in pygame.event.get():
+                if e.type == QUIT or (e.type == KEYDOWN and e.key == K_ESCAPE):
+                    print 'Stopped after %d of %d targets' % (found, len(targets))
+                    return self.algorithm.calculate()
+        
+        print 'Found %d of %d targets' % (found, len(targets))
+        return self.algorithm.calculate()
+        
 def usage():
     print 'Interactively calculate a camera-projector homography.  Point an'
     print 'IR camera at a display, and run the script.  Align an IR LED,'
@@ -283,6 +993,14 @@ def usage():
     print ' -h or --help            Displays this help text'
     print ' -p or --perspective     Uses the 4 corner points (default)'
     print ' -l or --leastsquares    Uses 4+ random points'
+    print ' -t or --threaded        Captures camera frames on a separate thread'
+    print ' -r or --roi             Tracks the LED in a window around its last position'
+    print ' -d or --detector        Finds the LED with mask or numpy[:2|4] (numpy for raw capture, else mask)'
+    print ' -o or --outliers        Leaves out points that miss by this many pixels'
+    print ' -a or --automatic       Finds a grid of targets shown on the display, no LED'
+    print '                         needed, e.g. -a 8x6'
+    print ' -s or --synthetic       Uses a simulated camera instead of a real one'
+    print ' -c or --capture         Captures RGB (default), YUV or raw frames from the camera'
     print ''
     print 'Usage:'
     print 'python homography.py matrix_file'
@@ -290,9 +1008,16 @@ def usage():
 if __name__ == '__main__':
     matrix_file = 'homography'
     mode = 0
+    threaded = False
+    tracking = False
+    detector = None
+    threshold = None
+    grid = None
+    synthetic = False
+    capture = 'RGB'
     
     try:
-        opts,args = getopt.gnu_getopt(sys.argv[1:], "hpl", ["help", "perspective", "leastsquares"])
+        opts,args = getopt.gnu_getopt(sys.argv[1:], "hpltrd:o:a:sc:", ["help", "perspective", "leastsquares", "threaded", "roi", "detector=", "outliers=", "automatic=", "synthetic", "capture="])
     except getopt.GetoptError, err:
         print str(err)
         usage()
@@ -306,6 +1031,20 @@ if __name__ == '__main__':
             mode = 0
         elif o in ("-l", "--leastsquares"):
             mode = 1
+        elif o in ("-t", "--threaded"):
+            threaded = True
+        elif o in ("-r", "--roi"):
+            tracking = True
+        elif o in ("-d", "--detector"):
+            detector = a
+        elif o in ("-o", "--outliers"):
+            threshold = float(a)
+        elif o in ("-a", "--automatic"):
+            grid = tuple([int(n) for n in a.split('x')])
+        elif o in ("-s", "--synthetic"):
+            synthetic = True
+        elif o in ("-c", "--capture"):
+            capture = a
     
     if len(args) > 0:
         matrix_file = args[0]
@@ -314,18 +1053,33 @@ if __name__ == '__main__':
     display_resolutions = pygame.display.list_modes()
     resolution = display_resolutions[0]
 
-    if mode == 0:
-        algo = PerspectiveTransform(resolution)
-    elif mode == 1:
-        algo = LeastSquaresTransform(resolution)
+    # automatic calibration takes every point it finds, not just 4 corners
+    if mode == 0 and not grid:
+        algo = PerspectiveTransform(resolution, threshold)
+    else:
+        algo = LeastSquaresTransform(resolution, threshold)
     
-#    source = FakeSource()
-    if CAMERA_SUPPORT:
-        source = IRCamera()
+    source = None
+    if synthetic:
+        # a camera looking at the display a bit skewed
+        skew = PerspectiveTransform(resolution)
+        for d, c in zip([(0,0), (resolution[0],0), (0,resolution[1]), resolution],
+                        [(60,40), (590,30), (40,450), (610,440)]):
+            skew.add_point(d, c)
+        source = SyntheticSource(skew.calculate(), detector=make_detector(detector))
+    elif CAMERA_SUPPORT:
+        source = IRCamera(threaded, tracking=tracking, detector=make_detector(detector), mode=capture)
         
     if source:
         hom = Homography(resolution, algo, source)
-        m = hom.run()
+        if grid:
+            m = hom.run_automatic(grid)
+        else:
+            m = hom.run()
+        source.stop()
+        if m is not None:
+            for d, c, e, i in zip(algo.display_points, algo.camera_points, algo.errors(), algo.inliers):
+                print '%s -> %s misses by %.2f pixels%s' % (repr(c), repr(d), e, '' if i else ', left out')
         print 'Saving matrix to %s.npy\n %s' % (matrix_file, repr(m))
         numpy.save(matrix_file,m)
     else:
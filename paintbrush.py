@@ -20,67 +20,1409 @@ or just any old picture.
 
 #!/usr/bin/env python
 
+import os
 import sys
+import time
 import math
 import getopt
+import threading
+import csv
+import struct
+import json
+import collections
 import numpy
 from numpy import linalg
 import serial
+try:
+    import resource
+except ImportError:
+    resource = None
 import pygame
 from homography import *
+from session import SessionRecorder, ReplaySource, NullPort
+
+# the grey each ink level is shown as, chosen so that average_color of a
+# level comes back out as the same level
+LEVEL_GREYS = numpy.array([255, 183, 135, 87, 39], numpy.uint8)
+
+def bayer(n):
+    # the n by n ordered dithering matrix, n a power of two
+    if n == 1:
+        return numpy.zeros((1, 1), numpy.int32)
+    m = 4*bayer(n // 2)
+    return numpy.vstack([numpy.hstack([m, m+2]), numpy.hstack([m+3, m+1])])
+
+def floyd_steinberg(values):
+    # error diffusion has to go in order, but a pixel only depends on the one
+    # to its left and the three above, so every pixel on a line x + 2y = t
+    # can be done at once
+    h, w = values.shape
+    levels = numpy.zeros((h, w), numpy.uint8)
+    # padded by a column on each side and a row below for the spilled error
+    error = numpy.zeros((h+1, w+2), numpy.float32)
+    error[:h, 1:w+1] = values
+    for t in range(w + 2*(h-1)):
+        ys = numpy.arange(max(0, (t - w + 2) // 2), min(h-1, t // 2) + 1)
+        xs = t - 2*ys + 1
+        value = error[ys, xs]
+        q = numpy.clip(numpy.floor(value + 0.5), 0, 4)
+        levels[ys, xs-1] = q
+        e = value - q
+        # each neighbour is its own statement, since two pixels on the same
+        # line can spill into one neighbour from different directions
+        error[ys, xs+1] += e*(7/16.0)
+        error[ys+1, xs-1] += e*(3/16.0)
+        error[ys+1, xs] += e*(5/16.0)
+        error[ys+1, xs+1] += e*(1/16.0)
+    return levels
+
+def dither(grey, method='floyd'):
+    """Return the 0-4 ink level of each dot of a greyscale [y, x] raster
+    
+    method is none to round each dot down like the old sampler did, ordered
+    for an 8x8 Bayer pattern, or floyd for Floyd-Steinberg error diffusion.
+    """
+    # a level is worth 48 of darkness, and the darkest 63 are all full ink
+    values = numpy.minimum(4.0, (255 - grey.astype(numpy.float32)) / 48)
+    if method == 'none':
+        return values.astype(numpy.uint8)
+    elif method == 'ordered':
+        h, w = grey.shape
+        m = bayer(8)
+        threshold = (numpy.tile(m, (h // 8 + 1, w // 8 + 1))[:h, :w] + 0.5) / 64
+        return numpy.minimum(4, numpy.floor(values + threshold)).astype(numpy.uint8)
+    elif method == 'floyd':
+        return floyd_steinberg(values)
+    raise ValueError('unknown dithering method %s' % method)
+
+def levels_cache(filename, canvas_size, method):
+    # where the dithered levels of an image are kept, next to the image
+    return '%s.levels-%dx%d-%s.npy' % ((os.path.splitext(filename)[0],) + canvas_size + (method,))
+
+def quantize(total, n):
+    """Return the 0-4 ink level of runs of n dots whose levels add up to
+    total, rounded to the nearest level"""
+    level = (2*total + n) // (2*numpy.maximum(n, 1))
+    return numpy.where(n > 0, level, 0).astype(numpy.int32)
+
+def swath(start, end, rows):
+    """Return the x and y of every dot each nozzle passes over moving from
+    start to end, one row per nozzle, not including start itself"""
+    x0, y0 = int(start[0]), int(start[1])
+    x1, y1 = int(end[0]), int(end[1])
+    dx, dy = x1 - x0, y1 - y0
+    # step along the longer axis so that no row or column is skipped,
+    # with a point for every nozzle at every step
+    steps = max(abs(dx), abs(dy))
+    if steps:
+        t = numpy.arange(1, steps+1) / float(steps)
+    else:
+        t = numpy.zeros(1)
+    xs = numpy.rint(x0 + dx*t).astype(numpy.intp)
+    ys = numpy.rint(y0 + dy*t).astype(numpy.intp)
+    xs = numpy.tile(xs, (len(rows), 1))
+    ys = ys[numpy.newaxis, :] + rows[:, numpy.newaxis]
+    return xs, ys
+
+def first_pass(xs, ys, inside, width):
+    """Return which of the dots from swath() belong to the nozzle there
+    
+    A dot belongs to the first nozzle to reach it, step by step along the
+    stroke and from the top nozzle down within a step, so a dot that more
+    than one nozzle passes over is only inked once.
+    """
+    # step major, so the first time a dot turns up is when it was reached
+    keys = (ys*width + xs).T.ravel()
+    order = numpy.flatnonzero(inside.T.ravel())
+    unique, first = numpy.unique(keys[order], return_index=True)
+    owned = numpy.zeros(len(keys), bool)
+    owned[order[first]] = True
+    return owned.reshape(xs.shape[::-1]).T
+
+def peak_memory():
+    # the most memory the process has held in its life in MB, where the OS
+    # says, so what one step used only shows if it pushed the peak higher
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux counts kilobytes, and os x counts bytes
+    if sys.platform != 'darwin':
+        peak *= 1024
+    return peak / 1048576.0
+
+def span(m, n, start, stop):
+    # the input range that output start to stop of n resampled from m reads
+    if n < m:
+        s = float(m) / n
+        return int(start*s), min(m, int(math.ceil(stop*s)))
+    lo = (start + 0.5)*m/n - 0.5
+    hi = (stop - 0.5)*m/n - 0.5
+    return max(0, int(math.floor(lo))), min(m, int(math.floor(hi)) + 2)
+
+def resample(a, offset, m, n, start, stop):
+    """Resize the rows of a from m to n columns, returning columns start to
+    stop, where a holds the input columns from offset on
+    
+    Shrinking averages the area each output column covers, and growing
+    interpolates linearly, so any window of the output comes out the same
+    as the matching part of the whole.
+    """
+    i = numpy.arange(start, stop)
+    w = a.shape[-1]
+    if n < m:
+        s = float(m) / n
+        # whole columns are summed on their own, so the result barely
+        # depends on where a starts, and only the fractions at each end are
+        # weighted
+        sums = numpy.zeros(a.shape[:-1] + (w+1,), numpy.result_type(a.dtype, numpy.int64))
+        numpy.cumsum(a, axis=-1, out=sums[..., 1:])
+        e0, e1 = i*s - offset, (i+1)*s - offset
+        k0 = numpy.clip(numpy.floor(e0).astype(numpy.intp), 0, w-1)
+        k1 = numpy.clip(numpy.floor(e1).astype(numpy.intp), 0, w-1)
+        total = sums[..., k1] - sums[..., k0] + a[..., k1]*(e1 - k1) - a[..., k0]*(e0 - k0)
+        return total / s
+    
+    p = numpy.clip((i + 0.5)*m/n - 0.5, 0, m-1) - offset
+    k = numpy.clip(numpy.floor(p).astype(numpy.intp), 0, max(0, w-2))
+    f = (p - k).astype(numpy.float32)
+    return a[..., k]*(1 - f) + a[..., numpy.minimum(k+1, w-1)]*f
+
+class GreyImage:
+    """Reads an image as greyscale, fitted to a canvas a piece at a time
+    
+    read(rect, size) -- Return the brightness of part of a canvas of size
+    canvas(size) -- Return the brightness of a whole canvas of size
+    
+    Only the source pixels under the part being read are converted, with
+    8.8 fixed point luminance, and they are resized as a single channel,
+    so a whole canvas never needs more than the source image, the result
+    and a band of rows.
+    """
+    
+    def __init__(self, filename, band=64):
+        image = pygame.image.load(filename)
+        if image.get_bitsize() < 24:
+            # pixels3d needs whole bytes for each channel
+            rgb = pygame.Surface(image.get_size(), 0, 24)
+            rgb.blit(image, (0, 0))
+            image = rgb
+        self.image = image
+        self.size = image.get_size()
+        self.band = band
+        
+    def luminance(self, left, top, right, bottom):
+        # 77, 151 and 28 out of 256 are the 30/59/11 weights of the old
+        # conversion, and the most they add up to still fits in 16 bits
+        rgb = pygame.surfarray.pixels3d(self.image)[left:right, top:bottom]
+        grey = rgb[:, :, 0].astype(numpy.uint16)
+        grey *= 77
+        channel = rgb[:, :, 1].astype(numpy.uint16)
+        channel *= 151
+        grey += channel
+        channel[...] = rgb[:, :, 2]
+        channel *= 28
+        grey += channel
+        grey += 128
+        grey >>= 8
+        del rgb
+        return grey.T
+        
+    def read(self, rect, size):
+        """Return the brightness of part of a canvas of size"""
+        rect = pygame.Rect(rect)
+        grey = numpy.empty((rect.height, rect.width), numpy.uint8)
+        grey.fill(255)
+        fitted = pygame.Rect((0, 0), self.size).fit(pygame.Rect((0, 0), size))
+        area = rect.clip(fitted)
+        if not area.width or not area.height:
+            return grey
+        
+        (mw, mh), (nw, nh) = self.size, fitted.size
+        x0, x1 = area.left - fitted.left, area.right - fitted.left
+        left, right = span(mw, nw, x0, x1)
+        for top in range(area.top, area.bottom, self.band):
+            # one band of output rows, from just the source rows under it
+            bottom = min(area.bottom, top + self.band)
+            y0, y1 = top - fitted.top, bottom - fitted.top
+            above, below = span(mh, nh, y0, y1)
+            rows = resample(self.luminance(left, above, right, below), left, mw, nw, x0, x1)
+            part = resample(rows.T, above, mh, nh, y0, y1).T
+            grey[top-rect.top:bottom-rect.top, area.left-rect.left:area.right-rect.left] = \
+                numpy.clip(numpy.rint(part), 0, 255)
+        return grey
+        
+    def canvas(self, size):
+        """Return the brightness of a whole canvas of size"""
+        return self.read(pygame.Rect((0, 0), size), size)
+
+class NozzleSampler:
+    """Looks up nozzle ink levels from a raster of the canvas's ink levels
+    
+    Keeps the total level of every block of dots along each row, so the ink
+    under a long run comes from a few block totals and two short partial
+    blocks, and clearing a stroke only redoes the blocks it touched rather
+    than everything right of it.  Short runs are just added up.  The raster
+    is the dithered 0-4 level of every dot, as from dither().
+    
+    sweep(start, end) -- Return the nozzle levels over a stroke and clear it
+    """
+    
+    def __init__(self, levels, nozzles=12, block=64):
+        levels = numpy.asarray(levels, numpy.uint8)
+        self.height, self.width = levels.shape
+        self.block = block
+        # padded out to whole blocks with dots that take no ink, and rows
+        # come first so that each nozzle's run is contiguous in memory
+        count = (self.width + block - 1) // block
+        self.padded = numpy.zeros((self.height, count*block), numpy.uint8)
+        self.padded[:, :self.width] = levels
+        self.ink = self.padded[:, :self.width]
+        # blocks[y, b] is the total level of row y from b*block to (b+1)*block
+        self.blocks = self.padded.reshape(self.height, count, block).sum(2, dtype=numpy.int32)
+        self.rows = numpy.arange(nozzles)
+        
+    def total(self, y0, y1, x0, x1):
+        # the ink along each row from y0 to y1, between x0 and x1
+        b = self.block
+        b0, b1 = -(-x0 // b), x1 // b
+        if b1 - b0 < 2:
+            return self.ink[y0:y1, x0:x1].sum(1, dtype=numpy.int32)
+        return (self.blocks[y0:y1, b0:b1].sum(1) +
+                self.ink[y0:y1, x0:b0*b].sum(1, dtype=numpy.int32) +
+                self.ink[y0:y1, b1*b:x1].sum(1, dtype=numpy.int32))
+        
+    def restock(self, y0, y1, x0, x1):
+        # redo the totals of just the blocks a cleared window touched
+        b = self.block
+        b0, b1 = x0 // b, (x1 + b - 1) // b
+        self.blocks[y0:y1, b0:b1] = self.padded[y0:y1, b0*b:b1*b].reshape(y1-y0, b1-b0, b).sum(2)
+        
+    def run(self, x, y, width):
+        # the levels of a level stroke, cleared as they are read
+        nozzles = len(self.rows)
+        x0 = max(0, x)
+        x1 = min(self.width, x + width)
+        y1 = min(self.height, y + nozzles)
+        if x1 <= x0 or y < 0 or y1 <= y:
+            return numpy.zeros(nozzles, numpy.int32), (numpy.zeros(0, numpy.intp), numpy.zeros(0, numpy.intp))
+        
+        n = x1 - x0
+        total = self.total(y, y1, x0, x1)
+        levels = quantize(total, n)
+        if y1 - y < nozzles:
+            # nozzles hanging off the bottom of the canvas stay off
+            levels = numpy.concatenate([levels, numpy.zeros(nozzles - (y1 - y), numpy.int32)])
+        self.ink[y:y1, x0:x1] = 0
+        b = self.block
+        if x0 // b == (x1 - 1) // b:
+            # inside one block, which loses just what was read
+            self.blocks[y:y1, x0 // b] -= total
+        else:
+            self.restock(y, y1, x0, x1)
+        ys, xs = divmod(numpy.arange(n*(y1-y)), n)
+        return levels, (xs + x0, ys + y)
+        
+    def sweep(self, start, end):
+        """Return the nozzle levels over a stroke and clear it
+        
+        Every dot the nozzles pass over moving from start to end, not
+        including start, which was painted by the last stroke, is painted
+        by the first nozzle to reach it.  Each nozzle gets the ink of its
+        own dots averaged over the length of its path, so the nozzles
+        following another's track only fill in what it hasn't already
+        covered.  Also returns the x and y indices of the pixels that were
+        cleared, each only once.
+        """
+        x0, y0 = int(start[0]), int(start[1])
+        x1, y1 = int(end[0]), int(end[1])
+        dx, dy = x1 - x0, y1 - y0
+        
+        if dy == 0:
+            # a level stroke is one run along each row, so use the totals
+            if dx > 0:
+                x, width = x0 + 1, dx
+            else:
+                x, width = x1, max(1, -dx)
+            return self.run(x, y1, width)
+        
+        xs, ys = swath(start, end, self.rows)
+        inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        owned = first_pass(xs, ys, inside, self.width)
+        
+        # nozzles that never touched the canvas stay off
+        ink = numpy.zeros(xs.shape, numpy.int32)
+        ink[owned] = self.ink[ys[owned], xs[owned]]
+        levels = quantize(ink.sum(1), inside.sum(1))
+        
+        # clear the swath and redo the totals of the blocks it touched
+        xs, ys = xs[owned], ys[owned]
+        if len(xs):
+            self.ink[ys, xs] = 0
+            self.restock(ys.min(), ys.max()+1, xs.min(), xs.max()+1)
+        return levels, (xs, ys)
+
+class TiledCanvas:
+    """Keeps the ink level raster of a large canvas in tiles on disk
+    
+    The raster lives in a memory-mapped file of square tiles, and only the
+    most recently used tiles are kept in memory.  Tiles are rendered and
+    dithered from the source image the first time the brush reaches them,
+    and dirty tiles are written back when they fall out of the cache.
+    Floyd-Steinberg error isn't carried over from one tile to the next.
+    
+    sweep(start, end) -- Return the nozzle levels over a stroke and clear it
+    window(left, top, right, bottom) -- Return the ink levels of part of the canvas
+    flush() -- Write every dirty tile back to the file
+    
+    overview is a downsampled copy of the canvas for the display, shown at
+    scale, which is kept up to date with what has been painted.  rendered
+    says which tiles an earlier session already left in the file at path,
+    to carry on from where it stopped.  A coverage map, if given one, is
+    told the real ink of each tile as it is rendered.
+    """
+    
+    def __init__(self, image, canvas_size, path, nozzles=12, tile=256, cache=64, overview=1024, method='floyd', rendered=None):
+        # image is a GreyImage, which can be read a tile at a time
+        self.image = image
+        self.method = method
+        self.canvas_size = canvas_size
+        self.width, self.height = canvas_size
+        self.tile = tile
+        self.capacity = cache
+        self.rows = numpy.arange(nozzles)
+        
+        self.shape = ((self.height + tile - 1) // tile, (self.width + tile - 1) // tile)
+        if rendered is not None and os.path.exists(path):
+            self.tiles = numpy.memmap(path, numpy.uint8, 'r+', shape=self.shape + (tile, tile))
+            self.rendered = numpy.array(rendered, bool)
+        else:
+            self.tiles = numpy.memmap(path, numpy.uint8, 'w+', shape=self.shape + (tile, tile))
+            self.rendered = numpy.zeros(self.shape, bool)
+        self.coverage = None
+        self.cache = collections.OrderedDict()
+        self.dirty = set()
+        self.loads = 0
+        self.evictions = 0
+        
+        # the overview shrinks the canvas by a power of two no bigger than a
+        # tile, so each of its pixels is a block inside exactly one tile
+        k = 1
+        while max(canvas_size) > overview*k and k < tile:
+            k *= 2
+        self.factor = k
+        self.scale = 1.0/k
+        size = ((self.width + k - 1) // k, (self.height + k - 1) // k)
+        self.overview = pygame.Surface(size, 0, 32)
+        pixels = pygame.surfarray.pixels3d(self.overview)
+        pixels[...] = image.canvas(size).T[:, :, numpy.newaxis]
+        del pixels
+        # tiles from an earlier session may already be partly painted
+        for ty, tx in zip(*numpy.nonzero(self.rendered)):
+            t = self.tile
+            self.update_overview(tx*t, ty*t, min(self.width, tx*t + t), min(self.height, ty*t + t))
+    
+    def render(self, ty, tx):
+        # read just the part of the source image under this tile
+        t = self.tile
+        grey = self.image.read((tx*t, ty*t, t, t), self.canvas_size)
+        self.tiles[ty, tx] = dither(grey, self.method)
+        self.rendered[ty, tx] = True
+        if self.coverage is not None:
+            # the coverage only had an estimate for this tile until now
+            ink = self.tiles[ty, tx][:min(t, self.height - ty*t), :min(t, self.width - tx*t)]
+            self.coverage.recount(ink, tx*t, ty*t, True)
+    
+    def get(self, ty, tx):
+        key = (ty, tx)
+        ink = self.cache.pop(key, None)
+        if ink is None:
+            if not self.rendered[ty, tx]:
+                self.render(ty, tx)
+            ink = numpy.array(self.tiles[ty, tx])
+            self.loads += 1
+            if len(self.cache) >= self.capacity:
+                self.evict()
+        # the most recently used tiles are at the end
+        self.cache[key] = ink
+        return ink
+    
+    def evict(self):
+        key, ink = self.cache.popitem(last=False)
+        if key in self.dirty:
+            self.tiles[key] = ink
+            self.dirty.discard(key)
+        self.evictions += 1
+    
+    def flush(self):
+        """Write every dirty tile back to the file"""
+        for key in self.dirty:
+            self.tiles[key] = self.cache[key]
+        self.dirty = set()
+        self.tiles.flush()
+    
+    def window(self, left, top, right, bottom):
+        """Return the ink levels of part of the canvas"""
+        t = self.tile
+        ink = numpy.zeros((bottom - top, right - left), numpy.uint8)
+        for ty in range(top // t, (bottom - 1) // t + 1):
+            for tx in range(left // t, (right - 1) // t + 1):
+                x0, x1 = max(left, tx*t), min(right, tx*t + t)
+                y0, y1 = max(top, ty*t), min(bottom, ty*t + t)
+                tile = self.get(ty, tx)
+                ink[y0-top:y1-top, x0-left:x1-left] = tile[y0-ty*t:y1-ty*t, x0-tx*t:x1-tx*t]
+        return ink
+    
+    def sweep(self, start, end):
+        """Return the nozzle levels over a stroke and clear it
+        
+        The same as NozzleSampler.sweep, but only the tiles the nozzles
+        passed over are read and written.
+        """
+        xs, ys = swath(start, end, self.rows)
+        inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        owned = first_pass(xs, ys, inside, self.width)
+        ink = numpy.zeros(xs.shape, numpy.int32)
+        
+        t = self.tile
+        tys, txs = ys[owned] // t, xs[owned] // t
+        keys, index = numpy.unique(tys*self.shape[1] + txs, return_inverse=True)
+        px, py = xs[owned] % t, ys[owned] % t
+        found = numpy.zeros(len(px), numpy.int32)
+        for i, key in enumerate(keys):
+            ty, tx = divmod(int(key), self.shape[1])
+            tile = self.get(ty, tx)
+            mine = index == i
+            found[mine] = tile[py[mine], px[mine]]
+            tile[py[mine], px[mine]] = 0
+            self.dirty.add((ty, tx))
+        ink[owned] = found
+        
+        # nozzles that never touched the canvas stay off
+        levels = quantize(ink.sum(1), inside.sum(1))
+        xs, ys = xs[owned], ys[owned]
+        if len(xs):
+            self.update_overview(xs.min(), ys.min(), xs.max()+1, ys.max()+1)
+        return levels, (xs, ys)
+    
+    def update_overview(self, left, top, right, bottom):
+        # average the blocks of each tile that were painted back into the overview
+        k, t = self.factor, self.tile
+        pixels = pygame.surfarray.pixels3d(self.overview)
+        for ty in range(top // t, (bottom - 1) // t + 1):
+            for tx in range(left // t, (right - 1) // t + 1):
+                # block aligned part of the dirty area inside this tile
+                x0 = max(left, tx*t) // k * k - tx*t
+                y0 = max(top, ty*t) // k * k - ty*t
+                x1 = min(t, -(-(min(right, tx*t + t) - tx*t) // k) * k)
+                y1 = min(t, -(-(min(bottom, ty*t + t) - ty*t) // k) * k)
+                greys = LEVEL_GREYS[self.get(ty, tx)[y0:y1, x0:x1]]
+                blocks = greys.reshape((y1-y0) // k, k, (x1-x0) // k, k).mean(axis=(1, 3))
+                ox, oy = (tx*t + x0) // k, (ty*t + y0) // k
+                w = min(blocks.shape[1], self.overview.get_width() - ox)
+                h = min(blocks.shape[0], self.overview.get_height() - oy)
+                pixels[ox:ox+w, oy:oy+h] = blocks[:h, :w].T[:, :, numpy.newaxis].astype(numpy.uint8)
+        del pixels
+
+class CoverageMap:
+    """Keeps count of the ink left to paint in each tile of the canvas
+    
+    align(left, top, right, bottom) -- Grow a window out to whole tiles
+    recount(ink, left, top, fresh) -- Count the ink left in the tiles of a block of levels
+    estimate(grey) -- Guess the ink in every tile from a greyscale raster
+    progress() -- Return the fraction of the ink that has been painted
+    nearest(point) -- Return the tile with ink left that is closest to point
+    
+    Only the tiles a stroke cleared are ever recounted, and the totals are
+    kept as they go, so progress doesn't look at the canvas at all.  Ink is
+    counted in levels, so a tile of white dots is done from the start.
+    """
+    
+    def __init__(self, canvas_size, tile=32):
+        self.width, self.height = canvas_size
+        self.tile = tile
+        self.shape = ((self.height + tile - 1) // tile, (self.width + tile - 1) // tile)
+        self.remaining = numpy.zeros(self.shape, numpy.int64)
+        # all the ink there was to start with, and how much of it is left
+        self.total = 0
+        self.left = 0
+        
+    def align(self, left, top, right, bottom):
+        """Grow a window out to whole tiles"""
+        t = self.tile
+        left, top = left // t * t, top // t * t
+        right = min(self.width, -(-right // t) * t)
+        bottom = min(self.height, -(-bottom // t) * t)
+        return left, top, right, bottom
+        
+    def recount(self, ink, left, top, fresh=False):
+        """Count the ink left in the tiles of a block of levels
+        
+        The block starts on a tile corner and ends on one or at the edge of
+        the canvas, as from align().  fresh is for ink that hasn't been
+        painted at all, which replaces an estimate of what there was to
+        paint as well as what is left.
+        """
+        t = self.tile
+        h, w = ink.shape
+        if not h or not w:
+            return
+        ty, tx = top // t, left // t
+        if h <= t and w <= t:
+            # most strokes stay inside one tile
+            total = int(ink.sum(dtype=numpy.int64))
+            change = total - int(self.remaining[ty, tx])
+            self.remaining[ty, tx] = total
+        else:
+            change = self.recount_tiles(ink, tx, ty)
+        self.left += change
+        if fresh:
+            self.total += change
+            
+    def recount_tiles(self, ink, tx, ty):
+        t = self.tile
+        h, w = ink.shape
+        sums = numpy.add.reduceat(ink, range(0, h, t), axis=0, dtype=numpy.int64)
+        sums = numpy.add.reduceat(sums, range(0, w, t), axis=1)
+        counts = self.remaining[ty:ty + sums.shape[0], tx:tx + sums.shape[1]]
+        change = int(sums.sum() - counts.sum())
+        counts[...] = sums
+        return change
+            
+    def estimate(self, grey):
+        """Guess the ink in every tile from a greyscale raster
+        
+        grey has one dot for each tile.  Dithering keeps the average tone,
+        so the ink is about the level of that dot over the whole tile.
+        """
+        t = self.tile
+        dots = numpy.outer(numpy.minimum(t, self.height - t*numpy.arange(self.shape[0])),
+                           numpy.minimum(t, self.width - t*numpy.arange(self.shape[1])))
+        levels = numpy.minimum(4.0, (255 - grey.astype(numpy.float32)) / 48)
+        self.remaining[...] = numpy.rint(levels*dots)
+        self.total = self.left = int(self.remaining.sum())
+        
+    def progress(self):
+        """Return the fraction of the ink that has been painted"""
+        if self.total <= 0:
+            return 1.0
+        return 1 - self.left / float(self.total)
+        
+    def nearest(self, point):
+        """Return the tile with ink left that is closest to point, as a Rect"""
+        ys, xs = numpy.nonzero(self.remaining)
+        if not len(ys):
+            return None
+        t = self.tile
+        distance = (xs*t + t/2.0 - point[0])**2 + (ys*t + t/2.0 - point[1])**2
+        i = distance.argmin()
+        left, top = int(xs[i]*t), int(ys[i]*t)
+        return pygame.Rect(left, top, min(t, self.width - left), min(t, self.height - top))
+
+class MotionFilter:
+    """Smooths the brush position and predicts where it is going
+    
+    An alpha-beta filter on canvas positions.  Each predicted position is
+    pushed ahead by the age of the camera frame plus latency, the time left
+    for the command to go over serial and fire, so ink lands where the head
+    will be rather than where it was seen.
+    
+    update(point, timestamp) -- Return the predicted position of the brush
+    """
+    
+    def __init__(self, latency=0.03, alpha=0.6, beta=0.2, coast=2):
+        self.latency = latency
+        self.alpha = alpha
+        self.beta = beta
+        # how many frames in a row to guess through when the LED isn't seen
+        self.coast = coast
+        self.position = None
+        self.velocity = (0.0, 0.0)
+        self.timestamp = None
+        self.missed = 0
+        
+    def update(self, point, timestamp):
+        """Return the predicted position of the brush
+        
+        point is the measured position, or None if there wasn't one, in
+        which case the last motion is carried on for a few frames.
+        """
+        if self.position is None:
+            if point is None:
+                return None
+            self.position = point
+            self.velocity = (0.0, 0.0)
+            self.timestamp = timestamp
+            self.missed = 0
+            return self.predict(timestamp)
+        
+        dt = max(timestamp - self.timestamp, 1e-3)
+        self.timestamp = timestamp
+        guess = (self.position[0] + self.velocity[0]*dt, self.position[1] + self.velocity[1]*dt)
+        
+        if point is None:
+            self.missed += 1
+            if self.missed > self.coast:
+                self.position = None
+                return None
+            self.position = guess
+            return self.predict(timestamp)
+        
+        # correct the guess by some of what it missed by
+        self.missed = 0
+        rx = point[0] - guess[0]
+        ry = point[1] - guess[1]
+        self.position = (guess[0] + self.alpha*rx, guess[1] + self.alpha*ry)
+        self.velocity = (self.velocity[0] + self.beta*rx/dt, self.velocity[1] + self.beta*ry/dt)
+        return self.predict(timestamp)
+        
+    def predict(self, timestamp):
+        ahead = time.time() - timestamp + self.latency
+        return (self.position[0] + self.velocity[0]*ahead, self.position[1] + self.velocity[1]*ahead)
+
+# the framed protocol.  a packet is SYNC, VERSION, a sequence number, a
+# count of frames, each a 16-bit delay in tenths of a millisecond followed
+# by six bytes of packed levels, and a CRC-8 of everything after SYNC.  the
+# firmware answers every packet with ACK or NAK, its sequence number and
+# the firmware's version.  SYNC can't start or appear in a legacy command
+SYNC = 0x80
+VERSION = 1
+ACK = 0x06
+NAK = 0x15
+MAX_FRAMES = 8
+# a packet with no frames is a hello.  its sequence number is picked so
+# that no byte of it has the 0xC0 header, and legacy firmware reads every
+# byte as levels it has patterns for.  the checksum still comes out as a
+# level 3, so each hello is followed by a command turning everything off
+HELLO = 0x48
+
+def crc_table():
+    table = []
+    for i in range(256):
+        c = i
+        for bit in range(8):
+            if c & 0x80:
+                c = ((c << 1) ^ 0x07) & 0xFF
+            else:
+                c = (c << 1) & 0xFF
+        table.append(c)
+    return table
+
+CRC8 = crc_table()
+
+def crc8(data):
+    """Return the CRC-8 (polynomial 0x07) of a bytearray"""
+    c = 0
+    for b in data:
+        c = CRC8[c ^ b]
+    return c
+
+def pack_levels(levels):
+    # two 0-4 levels in each byte, three bits apiece
+    packed = bytearray(6)
+    for i in range(0, 6):
+        packed[i] = (levels[i*2] << 3) | levels[i*2+1]
+    return packed
+
+def legacy_command(levels):
+    """Return the bare 6 byte command for a set of nozzle levels"""
+    # give the first byte a 0xC0 header
+    command = pack_levels(levels)
+    command[0] |= 0xC0
+    return command
+
+def frame_packet(seq, frames):
+    """Return a framed packet of (delay, levels) frames, delay in seconds"""
+    body = bytearray([VERSION, seq, len(frames)])
+    for delay, levels in frames:
+        body.extend(struct.pack('<H', min(0xFFFF, int(round(delay*10000)))))
+        body.extend(pack_levels(levels))
+    return bytearray([SYNC]) + body + bytearray([crc8(body)])
+
+def average_levels(frames):
+    # legacy firmware can only hold one set of levels at a time
+    n = len(frames)
+    if n == 1:
+        return list(frames[0][1])
+    return [(sum([levels[i] for delay, levels in frames]) + n//2) // n for i in range(len(frames[0][1]))]
+
+def waiting(port):
+    # how many bytes can be read without blocking, from either pyserial api
+    if hasattr(port, 'in_waiting'):
+        return port.in_waiting
+    return port.inWaiting()
+
+class SerialWriter:
+    """Writes nozzle schedules to the InkShield from a separate thread
+    
+    send(schedule) -- Queue a schedule, replacing any still waiting
+    stats() -- Return the queue depth, throughput, latency and replies
+    stop(timeout) -- Stop the writer thread, waiting up to timeout seconds
+    
+    A schedule is a list of (delay, levels) frames, delay being seconds
+    after the firmware gets it.  Only the newest schedule ever waits to be
+    written, so a stalled port never holds up the caller.  A schedule that
+    is the same as the last one is skipped unless keepalive seconds have
+    passed since it was sent.  port can be anything with a write method,
+    like a pty or loopback.
+    
+    protocol is legacy for the bare 6 byte commands, framed for sequenced
+    and checksummed packets of several frames, or auto to say hello in the
+    framed protocol first and fall back to legacy if nothing answers.
+    Legacy firmware only gets the average of each schedule.  When framed,
+    at most window packets go unanswered at once, and any not answered
+    within timeout seconds are given up on.  Only the newest schedule is
+    ever sent again, when its packet is rejected or given up on and nothing
+    newer is waiting, so the firmware doesn't go on playing levels that
+    were meant to have stopped, like a stroke whose end was lost.  An
+    Arduino resets when its port is opened, so hello is said again until
+    boot seconds have passed, to give the bootloader time to finish.
+    
+    A serial port given a write timeout gives up on writes that stall, and
+    those commands are dropped and counted, since a newer one is on its way.
+    """
+    
+    def __init__(self, port, keepalive=0.5, protocol='auto', window=2, timeout=0.1, boot=3.0):
+        self.port = port
+        self.keepalive = keepalive
+        self.protocol = protocol
+        self.window = window
+        self.timeout = timeout
+        self.boot = boot
+        self.pending = None
+        self.queued = 0.0
+        # the newest schedule written, in case its packet is lost
+        self.sent = None
+        self.last = None
+        self.last_sent = 0.0
+        self.seq = 0
+        self.outstanding = collections.OrderedDict()
+        self.replies = bytearray()
+        
+        self.started = time.time()
+        self.written = 0
+        self.bytes = 0
+        self.skipped = 0
+        self.coalesced = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self.acked = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.resent = 0
+        self.stalls = 0
+        self.round_trip = 0.0
+        
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.write)
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def send(self, schedule):
+        """Queue a schedule, replacing any still waiting"""
+        key = tuple([(delay, tuple(levels)) for delay, levels in schedule])
+        now = time.time()
+        self.condition.acquire()
+        if key == self.last and now - self.last_sent < self.keepalive:
+            self.skipped += 1
+        else:
+            if self.pending is not None:
+                self.coalesced += 1
+            self.pending = schedule
+            self.queued = now
+            self.last = key
+            self.last_sent = now
+            self.condition.notify()
+        self.condition.release()
+        
+    def negotiate(self):
+        # ports that can't be read from can't answer a hello
+        if not hasattr(self.port, 'read'):
+            self.protocol = 'legacy'
+            return
+        # old firmware takes a hello for nozzle levels, so each is followed
+        # by turning them off.  new firmware takes that as a command too
+        hello = frame_packet(HELLO, []) + legacy_command([0]*12)
+        start = time.time()
+        while time.time() - start < self.boot and self.running:
+            # anything said while the bootloader runs is lost, so keep trying
+            self.put(hello)
+            deadline = time.time() + 3*self.timeout
+            while time.time() < deadline and self.running:
+                for kind, seq, version in self.receive():
+                    if kind == ACK and seq == HELLO and version == VERSION:
+                        self.protocol = 'framed'
+                        return
+                time.sleep(0.001)
+        self.protocol = 'legacy'
+        
+    def put(self, data):
+        # a port that stalls past its write timeout loses the command
+        try:
+            self.port.write(data)
+        except serial.SerialTimeoutException:
+            self.stalls += 1
+            return False
+        return True
+        
+    def receive(self):
+        # read whatever replies have come in and match them to packets
+        n = waiting(self.port)
+        if n:
+            self.replies.extend(self.port.read(n))
+        replies = []
+        while len(self.replies) >= 3:
+            if self.replies[0] not in (ACK, NAK):
+                del self.replies[0]
+                continue
+            replies.append(tuple(self.replies[:3]))
+            del self.replies[:3]
+        
+        now = time.time()
+        lost = False
+        for kind, seq, version in replies:
+            sent = self.outstanding.pop(seq, None)
+            if sent is None:
+                continue
+            if kind == ACK:
+                self.acked += 1
+                self.round_trip = 0.9*self.round_trip + 0.1*(now - sent)
+            else:
+                self.rejected += 1
+                lost = lost or seq == self.seq
+        # a late packet is worse than none, so it isn't sent again
+        for seq, sent in list(self.outstanding.items()):
+            if now - sent > self.timeout:
+                del self.outstanding[seq]
+                self.timeouts += 1
+                lost = lost or seq == self.seq
+        if lost:
+            self.resend()
+        return replies
+        
+    def resend(self):
+        # the newest packet never played, so its schedule goes again unless
+        # something newer is waiting, and repeats of it aren't skipped
+        self.condition.acquire()
+        self.last = None
+        if self.pending is None and self.sent is not None:
+            self.pending = self.sent
+            self.queued = time.time()
+            self.resent += 1
+        self.condition.release()
+        
+    def write(self):
+        """Write out whatever is newest, run by the writer thread"""
+        if self.protocol == 'auto':
+            self.negotiate()
+        while True:
+            self.condition.acquire()
+            while self.pending is None and self.running:
+                if self.outstanding:
+                    # keep up with the replies while there is nothing to send
+                    self.condition.wait(0.002)
+                    self.condition.release()
+                    self.receive()
+                    self.condition.acquire()
+                else:
+                    self.condition.wait()
+            self.condition.release()
+            
+            if self.protocol == 'framed':
+                # wait for room in the window, and then take whatever is
+                # newest by then
+                self.receive()
+                while len(self.outstanding) >= self.window and self.running:
+                    time.sleep(0.0005)
+                    self.receive()
+            
+            self.condition.acquire()
+            if not self.running:
+                self.condition.release()
+                return
+            schedule = self.pending
+            queued = self.queued
+            self.pending = None
+            self.condition.release()
+            
+            if self.protocol == 'framed':
+                self.seq = (self.seq + 1) % 256
+                command = frame_packet(self.seq, schedule[:MAX_FRAMES])
+                self.outstanding[self.seq] = time.time()
+            else:
+                command = legacy_command(average_levels(schedule))
+            if not self.put(command):
+                # nothing will answer a packet that never went out
+                self.outstanding.pop(self.seq, None)
+                continue
+            self.sent = schedule
+            latency = time.time() - queued
+            self.written += 1
+            self.bytes += len(command)
+            # a rolling average, but keep the worst case too
+            self.latency = 0.9*self.latency + 0.1*latency
+            self.max_latency = max(self.max_latency, latency)
+        
+    def stats(self):
+        """Return the queue depth, throughput, latency and replies"""
+        elapsed = max(time.time() - self.started, 1e-3)
+        return {'depth': int(self.pending is not None),
+                'protocol': self.protocol,
+                'written': self.written,
+                'skipped': self.skipped,
+                'coalesced': self.coalesced,
+                'bytes_per_second': self.bytes/elapsed,
+                'latency': self.latency,
+                'max_latency': self.max_latency,
+                'acked': self.acked,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'resent': self.resent,
+                'stalls': self.stalls,
+                'round_trip': self.round_trip}
+        
+    def stop(self, timeout=1.0):
+        """Stop the writer thread, waiting up to timeout seconds"""
+        self.condition.acquire()
+        self.running = False
+        self.condition.notify()
+        self.condition.release()
+        # the thread is a daemon, so one stuck in a write can be left behind
+        self.thread.join(timeout)
+
+class LoopProfiler:
+    """Times each stage of the main loop against a per-frame budget
+    
+    start() -- Mark the start of a loop iteration
+    stage(name) -- Mark the end of the named stage
+    end() -- Mark the end of an iteration, counting it if it ran long
+    count(name) -- Add one to a named counter, like dropped detections
+    percentiles(name) -- Return the p50, p95 and p99 of a stage in seconds
+    draw(surface) -- Draw the stage timings in the corner of surface, returning where
+    dump(filename) -- Write the timings to a .csv or .json file
+    
+    Only the last window samples of each stage are kept, so the numbers
+    follow what the rig is doing now rather than over the whole session.
+    """
+    
+    def __init__(self, budget=1/30.0, window=300):
+        self.budget = budget
+        self.window = window
+        self.stages = []
+        self.samples = {}
+        self.counters = {}
+        self.frames = 0
+        self.missed = 0
+        self.font = None
+        self.began = self.last = time.time()
+        
+    def start(self):
+        """Mark the start of a loop iteration"""
+        self.began = self.last = time.time()
+        
+    def stage(self, name):
+        """Mark the end of the named stage"""
+        now = time.time()
+        self.add(name, now - self.last)
+        self.last = now
+        
+    def end(self):
+        """Mark the end of an iteration, counting it if it ran long"""
+        total = time.time() - self.began
+        self.add('total', total)
+        self.frames += 1
+        if total > self.budget:
+            self.missed += 1
+            
+    def add(self, name, seconds):
+        if name not in self.samples:
+            self.stages.append(name)
+            self.samples[name] = collections.deque(maxlen=self.window)
+        self.samples[name].append(seconds)
+            
+    def count(self, name):
+        """Add one to a named counter, like dropped detections"""
+        self.counters[name] = self.counters.get(name, 0) + 1
+        
+    def percentiles(self, name):
+        """Return the p50, p95 and p99 of a stage in seconds"""
+        return tuple(numpy.percentile(list(self.samples[name]), [50, 95, 99]))
+        
+    def draw(self, surface):
+        """Draw the stage timings in the corner of surface, returning where"""
+        if self.font is None:
+            self.font = pygame.font.Font(None, 18)
+        lines = ['stage       p50    p95    p99 ms']
+        for name in self.stages:
+            p = self.percentiles(name)
+            lines.append('%-9s %6.1f %6.1f %6.1f' % ((name,) + tuple([t*1000 for t in p])))
+        lines.append('missed %d of %d frames' % (self.missed, self.frames))
+        for name in sorted(self.counters):
+            lines.append('%s %d' % (name, self.counters[name]))
+        
+        y = 4
+        area = None
+        for line in lines:
+            text = self.font.render(line, True, (255, 0, 0), (255, 255, 255))
+            rect = surface.blit(text, (4, y))
+            area = area and area.union(rect) or rect
+            y += text.get_height()
+        return area
+        
+    def summary(self):
+        stages = []
+        for name in self.stages:
+            times = numpy.array(self.samples[name])
+            p50, p95, p99 = self.percentiles(name)
+            stages.append({'stage': name, 'samples': len(times), 'mean': times.mean(),
+                           'p50': p50, 'p95': p95, 'p99': p99, 'max': times.max()})
+        return {'budget': self.budget, 'frames': self.frames, 'missed': self.missed,
+                'counters': self.counters, 'stages': stages}
+        
+    def dump(self, filename):
+        """Write the timings to a .csv or .json file"""
+        summary = self.summary()
+        f = open(filename, 'wb')
+        if filename.endswith('.json'):
+            json.dump(summary, f, indent=2)
+        else:
+            writer = csv.writer(f)
+            fields = ['stage', 'samples', 'mean', 'p50', 'p95', 'p99', 'max']
+            writer.writerow(fields)
+            for stage in summary['stages']:
+                writer.writerow([stage[k] for k in fields])
+            writer.writerow(['missed', summary['missed'], summary['frames']])
+            for name in sorted(summary['counters']):
+                writer.writerow([name, summary['counters'][name]])
+        f.close()
+
+class FrameScheduler:
+    """Paces the main loop to the camera, backing off while idle
+    
+    wait(active) -- Block until the loop should go around again
+    interval() -- Return the time expected between frames while active
+    rates() -- Return the achieved and target loop rates
+    
+    While active, the loop goes around as soon as the camera has a new
+    frame, so it runs as fast as the camera does.  Once it has been idle
+    for linger seconds, it only goes around idle_rate times a second, to
+    leave the CPU alone between strokes.  timeout is the longest it waits
+    for a frame, so events are still handled if the camera stalls.  A
+    source that isn't paced, like a replay read as fast as it goes, is never
+    held back while idle.
+    """
+    
+    def __init__(self, camera, idle_rate=5.0, linger=0.5, timeout=0.1):
+        self.camera = camera
+        self.idle_rate = idle_rate
+        self.linger = linger
+        self.timeout = timeout
+        self.last = time.time()
+        self.last_active = self.last
+        # loops and seconds spent, while active and while idle
+        self.loops = {True: 0, False: 0}
+        self.seconds = {True: 0.0, False: 0.0}
+        
+    def wait(self, active):
+        """Block until the loop should go around again"""
+        now = time.time()
+        if active:
+            self.last_active = now
+        # a moment without the LED is likely just a hand in the way
+        active = active or now - self.last_active < self.linger
+        if active:
+            self.camera.wait(self.timeout)
+        elif self.camera.paced:
+            remaining = self.last + 1.0/self.idle_rate - now
+            if remaining > 0:
+                time.sleep(remaining)
+        
+        now = time.time()
+        self.loops[active] += 1
+        self.seconds[active] += now - self.last
+        self.last = now
+        return active
+        
+    def interval(self):
+        """Return the time expected between frames while active"""
+        return self.camera.interval or 1/30.0
+        
+    def rates(self):
+        """Return the achieved and target loop rates"""
+        rates = {'idle_target': None, 'target': None}
+        if self.camera.paced:
+            rates['idle_target'] = self.idle_rate
+        if self.camera.interval:
+            rates['target'] = 1/self.camera.interval
+        for active, name in [(True, 'active'), (False, 'idle')]:
+            rates[name] = 0.0
+            if self.seconds[active] > 0:
+                rates[name] = self.loops[active]/self.seconds[active]
+        return rates
+
+# the cursor of each head, in order
+CURSOR_COLORS = [(127, 255, 127), (255, 127, 127), (127, 127, 255), (255, 255, 127)]
+
+class Brush:
+    """The state of one print head and the InkShield it is wired to
+    
+    locate(point, timestamp, bounds) -- Move the brush to a new canvas point
+    reset() -- Turn off every nozzle until the brush is next worked out
+    
+    writer sends the head's nozzle schedules, and latency is how far ahead
+    in seconds to predict where it is going, if at all.  nozzles is the
+    level of each nozzle over the whole frame, and schedule, if there is
+    one, is the same broken into timed frames along the stroke.
+    """
+    
+    def __init__(self, writer, nozzles=12, latency=None):
+        self.writer = writer
+        self.nozzles = [0]*nozzles
+        self.schedule = None
+        self.point = None
+        self.last_point = None
+        self.motion = None
+        if latency is not None:
+            self.motion = MotionFilter(latency)
+        self.dx = 0.0
+        
+    def locate(self, point, timestamp, bounds):
+        """Move the brush to a new canvas point, or lose it if it is None or
+        outside of bounds"""
+        if self.motion:
+            # smooth out jitter and lead the brush to where it will be when
+            # the command fires, guessing for a frame or two if it was lost
+            point = self.motion.update(point, timestamp)
+        
+        if point and bounds.collidepoint(point):
+            # calculate how fast the brush is moving
+            if self.point:
+                self.dx = point[0]-self.point[0]
+            else:
+                self.dx = 0.0
+            self.last_point = self.point
+            self.point = point
+        else:
+            self.point = None
+            self.last_point = None
+        
+    def reset(self):
+        """Turn off every nozzle until the brush is next worked out"""
+        self.nozzles = [0]*len(self.nozzles)
+        self.schedule = None
 
 class Paintbrush:
-    def __init__(self, filename, serialport, canvas_inches):
+    def __init__(self, filename, serialport, canvas_inches, average_color=False, threaded=False,
+                 tracking=False, detector=None, latency=None, calibration='calibration',
+                 recalibrate=False, profile=None, camera=None, record=None, record_frames=0,
+                 port=None, scale=1.0, tiles=None, dithering='floyd', protocol='auto',
+                 capture='RGB', progress=None):
         pygame.init()
-        self.camera = IRCamera()
-        if serialport == None:
-            serialport = 0
-        self.port = serial.Serial(serialport, 115200, timeout=200)
+        # camera can be any point source, like a replayed session
+        if camera is None:
+            camera = IRCamera(threaded, tracking=tracking, detector=detector, mode=capture)
+        self.recorder = None
+        if record:
+            self.recorder = SessionRecorder(camera, record, record_frames)
+            camera = self.recorder
+        self.camera = camera
+        # port can be anything with a write method standing in for the
+        # Arduino, or a list of them, and each one drives its own head
+        if port is None:
+            if serialport == None:
+                serialport = 0
+            if not isinstance(serialport, list):
+                serialport = [serialport]
+            # a stalled write gives up rather than hang the writer thread,
+            # with the name pyserial has taken since its first versions
+            port = [serial.Serial(p, 115200, timeout=200, writeTimeout=0.5) for p in serialport]
+        elif not isinstance(port, list):
+            port = [port]
+        self.brushes = [Brush(SerialWriter(p, protocol=protocol), latency=latency) for p in port]
+        # firmware that understands framed packets is sent each stroke in
+        # this many pieces, played out over the frame_time until the next
+        self.subframes = 4
+        self.frame_time = 1/30.0
+        # with more than one head, the LEDs are told apart by where they were
+        self.tracker = None
+        if len(self.brushes) > 1:
+            self.tracker = PointTracker(len(self.brushes))
         self.display = pygame.display.set_mode((640, 480),0)
-        self.clock = pygame.time.Clock()
+        self.scheduler = FrameScheduler(camera)
+        # timings are always kept, but only shown and saved when profiling
+        self.profiler = LoopProfiler(1/30.0)
+        self.profile = profile
         
         # size of the canvas in dots.  the cartridge is 96dpi
         self.canvas_size = (int(canvas_inches[0]*96), int(canvas_inches[1]*96))
-        # scale and fit the image to the canvas size
-        image = pygame.image.load(filename)
-        image = self.convert_to_greyscale(image)
-        image_rect = image.get_rect()
-        canvas_rect = pygame.Rect((0, 0), self.canvas_size)
-        image_rect = image_rect.fit(canvas_rect)
-        image = pygame.transform.smoothscale(image, (image_rect.size))
-        self.canvas = pygame.Surface(canvas_rect.size, 0, self.display)
-        self.canvas.fill((255, 255, 255))
-        self.canvas.blit(image, image_rect.topleft)
+        self.canvas_rect = pygame.Rect((0, 0), self.canvas_size)
+        # the canvas is shown at scale, and only the parts that change are
+        # redrawn: what was cleared, and where the cursor and overlay were
+        self.scale = scale
+        # progress is where what has been painted so far is kept, so a long
+        # painting can be picked up again in another session
+        self.progress = progress
+        self.coverage = CoverageMap(self.canvas_size)
+        saved = self.load_progress(tiles)
+        if tiles:
+            # a tiled canvas is only ever rendered a tile at a time, and
+            # shown through its own overview
+            self.canvas = None
+            image = GreyImage(filename)
+            rendered = saved and saved['rendered']
+            self.sampler = TiledCanvas(image, self.canvas_size, tiles, method=dithering, rendered=rendered)
+            self.scale = self.sampler.scale
+            average_color = False
+            if not saved:
+                # tiles are only dithered once reached, so until then their
+                # ink is guessed from the image
+                self.coverage.estimate(image.canvas(self.coverage.shape[::-1]))
+            self.sampler.coverage = self.coverage
+        else:
+            # the canvas shows the dithered levels that will be painted
+            levels = self.load_levels(filename, dithering)
+            if saved:
+                levels = saved['ink']
+            else:
+                self.coverage.recount(levels, 0, 0, True)
+            self.canvas = pygame.Surface(self.canvas_rect.size, 0, self.display)
+            pixels = pygame.surfarray.pixels3d(self.canvas)
+            pixels[...] = LEVEL_GREYS[levels.T][:, :, numpy.newaxis]
+            del pixels
+            self.sampler = NozzleSampler(levels)
+        # average_color is the old, slower way of sampling the canvas
+        self.average_color = average_color
+        
+        self.preview = None
+        self.dirty = []
+        self.cursors = []
+        self.overlay = None
+        self.redraw = True
         
         self.transformer = PerspectiveTransform(self.canvas_size)
         self.transform = []
-        self.nozzles = [0]*12
-        self.point = None
-        self.dx = 0.0
+        # saved calibrations are checked against this canvas point
+        self.calibration = calibration
+        self.recalibrate = recalibrate
+        self.reference = (0, 0)
+        self.tolerance = 12
         self.painting = False
+        self.guides = []
+        self.font = None
         
-    # fast conversion from rgb to a desaturated greyscale image
-    def convert_to_greyscale(self, image):
-        array = pygame.surfarray.pixels3d(image)
-        iarray = array.astype(numpy.int)
-        # slicing hint from http://dmr.ath.cx/gfx/python/
-        r = iarray[:, :, 0]
-        g = iarray[:, :, 1]
-        b = iarray[:, :, 2]
-        # convert to greyscale by luminance
-        gray = (30*r+59*g+11*b)/100
-        gray = gray.astype(numpy.uint8)
-        array[:, :, 0] = gray
-        array[:, :, 1] = gray
-        array[:, :, 2] = gray
-        return image
+    def load_levels(self, filename, method):
+        # dithering takes a while, so the levels are kept next to the image
+        # and only redone when the image changes
+        cached = levels_cache(filename, self.canvas_size, method)
+        if os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(filename):
+            return numpy.load(cached)
+        
+        start = time.time()
+        before = peak_memory()
+        grey = GreyImage(filename).canvas(self.canvas_size)
+        levels = dither(grey, method)
+        after = peak_memory()
+        if after is None:
+            print "Prepared %s in %.2fs" % (filename, time.time() - start)
+        else:
+            print "Prepared %s in %.2fs, raising the process's peak memory by %.1fMB to %.1fMB" % (filename, time.time() - start, after - before, after)
+        try:
+            numpy.save(cached, levels)
+        except IOError:
+            print "Couldn't save the dithered image to %s" % cached
+        return levels
         
     def update_display(self, image):
         self.display.blit(image, (0, 0))
-        if self.point != None:
-            pygame.draw.rect(self.display, (127, 255, 127), (self.point[0], self.point[1], 12, 12), 3)
+        for brush in self.brushes:
+            if brush.point != None:
+                pygame.draw.rect(self.display, (127, 255, 127), (brush.point[0], brush.point[1], 12, 12), 3)
+        if self.profile:
+            self.profiler.draw(self.display)
         pygame.display.flip()
             
+    def show_canvas(self):
+        size = (int(self.canvas_size[0]*self.scale), int(self.canvas_size[1]*self.scale))
+        self.display = pygame.display.set_mode(size, 0)
+        if self.canvas is None:
+            self.preview = self.sampler.overview
+        elif self.scale == 1:
+            self.preview = self.canvas
+        else:
+            self.preview = pygame.transform.smoothscale(self.canvas, size)
+        self.redraw = True
+        
+    def to_display(self, rect):
+        s = self.scale
+        left, top = int(rect.left*s), int(rect.top*s)
+        right, bottom = int(math.ceil(rect.right*s)), int(math.ceil(rect.bottom*s))
+        return pygame.Rect(left, top, right-left, bottom-top)
+        
+    def update_preview(self, rect):
+        # scale just this part of the canvas back down into the preview
+        s = self.scale
+        area = pygame.Rect(int(rect.left/s), int(rect.top/s), 0, 0)
+        area.width = int(math.ceil(rect.right/s)) - area.left
+        area.height = int(math.ceil(rect.bottom/s)) - area.top
+        area = area.clip(self.canvas.get_rect())
+        if area.width and area.height:
+            part = pygame.transform.scale(self.canvas.subsurface(area), rect.size)
+            self.preview.blit(part, rect)
+        
+    def update_canvas(self):
+        rects = []
+        for r in self.dirty:
+            rect = self.to_display(r).clip(self.display.get_rect())
+            if self.canvas and self.preview is not self.canvas:
+                self.update_preview(rect)
+            rects.append(rect)
+        self.dirty = []
+        # put back what the cursor and overlay covered last time
+        for rect in self.cursors + self.guides + [self.overlay]:
+            if rect:
+                rects.append(rect)
+        
+        if self.redraw:
+            self.display.blit(self.preview, (0, 0))
+        else:
+            for rect in rects:
+                self.display.blit(self.preview, rect, rect)
+        
+        self.cursors = []
+        for head, brush in enumerate(self.brushes):
+            if brush.point != None:
+                box = self.to_display(pygame.Rect(int(brush.point[0]), int(brush.point[1]), 12, 12))
+                color = CURSOR_COLORS[head % len(CURSOR_COLORS)]
+                cursor = pygame.draw.rect(self.display, color, box, max(1, int(3*self.scale)))
+                self.cursors.append(cursor)
+                rects.append(cursor)
+        self.guides = self.draw_guides()
+        rects.extend(self.guides)
+        self.overlay = None
+        if self.profile:
+            self.overlay = self.profiler.draw(self.display)
+            rects.append(self.overlay)
+        
+        if self.redraw:
+            pygame.display.flip()
+            self.redraw = False
+        else:
+            pygame.display.update(rects)
+            
+    def draw_guides(self):
+        # show how much is done, and point out the closest part still to paint
+        guides = []
+        located = [brush.point for brush in self.brushes if brush.point != None]
+        if located:
+            region = self.coverage.nearest(located[0])
+            if region:
+                guides.append(pygame.draw.rect(self.display, (255, 127, 0), self.to_display(region), 2))
+        if self.font is None:
+            self.font = pygame.font.Font(None, 18)
+        text = self.font.render('%.1f%% painted' % (100*self.coverage.progress()), True, (255, 127, 0), (255, 255, 255))
+        guides.append(self.display.blit(text, (4, self.display.get_height() - text.get_height() - 4)))
+        return guides
+        
     def new_point(self):
         self.cal_point = self.transformer.generate_point()
         print "Calibrating, move the printer head to %s and press any key" % str(self.cal_point)
@@ -94,46 +1436,183 @@ class Paintbrush:
             return True
         else:
             self.transform = self.transformer.calculate()
+            self.reference = self.transformer.display_points[0]
+            self.save_calibration()
             print "Done calibrating, press any key to start painting!"
-            pygame.display.set_mode(self.canvas_size, 0)
+            self.show_canvas()
             return False
     
+    def load_progress(self, tiled):
+        if not self.progress:
+            return None
+        try:
+            f = numpy.load(self.progress)
+        except IOError:
+            return None
+        saved = dict(f.items())
+        f.close()
+        if tuple(saved['canvas_size']) != self.canvas_size or bool(saved['tiled']) != bool(tiled):
+            print "Progress in %s is for a different canvas, starting over" % self.progress
+            return None
+        self.coverage.remaining[...] = saved['remaining']
+        self.coverage.total = int(saved['total'])
+        self.coverage.left = int(saved['left'])
+        print "Picking up where %s left off, %.1f%% painted" % (self.progress, 100*self.coverage.progress())
+        return saved
+        
+    def save_progress(self):
+        if not self.progress:
+            return
+        c = self.coverage
+        saved = {'canvas_size': self.canvas_size, 'tiled': self.canvas is None,
+                 'remaining': c.remaining, 'total': c.total, 'left': c.left}
+        if self.canvas is None:
+            # the tiles themselves are already in their file
+            self.sampler.flush()
+            saved['rendered'] = self.sampler.rendered
+        else:
+            saved['ink'] = self.ink_window(0, 0, self.canvas_size[0], self.canvas_size[1])
+        f = open(self.progress, 'wb')
+        numpy.savez_compressed(f, **saved)
+        f.close()
+        
+    def ink_window(self, left, top, right, bottom):
+        # the ink levels left in part of the canvas, wherever they are kept
+        if self.canvas is None:
+            return self.sampler.window(left, top, right, bottom)
+        if not self.average_color:
+            return self.sampler.ink[top:bottom, left:right]
+        # average_color only clears the canvas, whose greys map back to levels
+        pixels = pygame.surfarray.pixels_red(self.canvas)
+        ink = numpy.minimum(4, (255 - pixels[left:right, top:bottom].T.astype(numpy.int32)) // 48)
+        del pixels
+        return ink
+        
+    def recount(self, rect):
+        # only the tiles that were just painted can have changed
+        left, top, right, bottom = self.coverage.align(rect.left, rect.top, rect.right, rect.bottom)
+        self.coverage.recount(self.ink_window(left, top, right, bottom), left, top)
+        
+    def calibration_file(self):
+        # a calibration only holds for the same camera and canvas
+        size = tuple(self.camera.resolution) + tuple(self.canvas_size)
+        return '%s-%dx%d-%dx%d.npz' % ((self.calibration,) + size)
+        
+    def load_calibration(self):
+        try:
+            saved = numpy.load(self.calibration_file())
+        except IOError:
+            return False
+        self.transform = saved['transform']
+        self.reference = tuple(saved['reference'])
+        saved.close()
+        return True
+        
+    def save_calibration(self):
+        numpy.savez(self.calibration_file(), transform=self.transform, reference=self.reference)
+        
+    def verify(self):
+        # the rig rarely moves, so one point is enough to trust a saved calibration
+        cam_point = self.camera.get_point()
+        if not cam_point:
+            print "Couldn't find the LED, recalibrating"
+            return False
+        
+        p = self.to_canvas(cam_point)
+        error = math.hypot(p[0]-self.reference[0], p[1]-self.reference[1])
+        if error > self.tolerance:
+            print "Saved calibration is off by %.1f dots, recalibrating" % error
+            return False
+        
+        print "Saved calibration is good, press any key to start painting!"
+        self.show_canvas()
+        return True
+        
+    def to_canvas(self, c):
+        # transform from the camera coordinates to canvas coordinates
+        p = self.transformer.apply(c, self.transform)
+        return (p[0, 0], p[0, 1])
+        
     def update_location(self):
-        c = self.camera.get_point()
-        if c:
-            # transform from the camera coordinates to canvas coordinates
-            p = numpy.array([c[0], c[1], 1])
-            p = numpy.dot(self.transform, p)
-            new_point = (p[0]/p[2], p[1]/p[2])
-            
-            if self.canvas.get_rect().collidepoint(new_point):
-                # calculate how fast the brush is moving
-                if self.point:
-                    self.dx = new_point[0]-self.point[0]
-                else:
-                    self.dx = 0.0
-                self.point = new_point
+        if self.tracker:
+            # one pass over the frame finds every LED, and the tracker works
+            # out which head is which
+            points = self.tracker.update(self.camera.get_points(len(self.brushes)))
+        else:
+            points = [self.camera.get_point()]
+        timestamp = self.camera.timestamp or time.time()
+        
+        for brush, c in zip(self.brushes, points):
+            new_point = None
+            if c:
+                new_point = self.to_canvas(c)
             else:
-                self.point = None
+                self.profiler.count('no detection')
+            brush.locate(new_point, timestamp, self.canvas_rect)
+        
+    def sweep_brush(self, brush):
+        # paint everything the nozzles passed over since the last frame, in
+        # whichever direction the brush went
+        start = brush.last_point or brush.point
+        end = brush.point
+        pieces = 1
+        if brush.writer.protocol == 'framed':
+            # no piece shorter than a dot
+            length = max(abs(int(end[0]) - int(start[0])), abs(int(end[1]) - int(start[1])))
+            pieces = max(1, min(self.subframes, length))
+        
+        schedule = []
+        cleared = []
+        for i in range(pieces):
+            a = (start[0] + (end[0]-start[0])*i/float(pieces), start[1] + (end[1]-start[1])*i/float(pieces))
+            b = (start[0] + (end[0]-start[0])*(i+1)/float(pieces), start[1] + (end[1]-start[1])*(i+1)/float(pieces))
+            levels, swept = self.sampler.sweep(a, b)
+            schedule.append((self.frame_time*i/float(pieces), levels.tolist()))
+            cleared.append(swept)
+        brush.schedule = schedule
+        brush.nozzles = average_levels(schedule)
+        if pieces == 1:
+            xs, ys = cleared[0]
         else:
-            self.point = None
+            xs = numpy.concatenate([swept[0] for swept in cleared])
+            ys = numpy.concatenate([swept[1] for swept in cleared])
+        
+        # clear the area we are painting so it isn't painted again in the future
+        if len(xs):
+            left, top = xs.min(), ys.min()
+            rect = pygame.Rect(int(left), int(top), int(xs.max()-left+1), int(ys.max()-top+1))
+            if self.canvas:
+                if pieces == 1 and len(xs) == rect.width*rect.height:
+                    # the dots fill their bounds, like a level stroke's do
+                    self.canvas.fill((255, 255, 255), rect)
+                else:
+                    pixels = pygame.surfarray.pixels2d(self.canvas)
+                    pixels[xs, ys] = self.canvas.map_rgb((255, 255, 255))
+                    del pixels
+            self.dirty.append(rect)
+            self.recount(rect)
         
-    def calculate_brush(self):
-        if self.dx < 0.0:
+    def calculate_brush(self, head=0):
+        brush = self.brushes[head]
+        if not self.average_color:
+            self.sweep_brush(brush)
             return
-        width = max(1,int(abs(self.dx)))
         
-        x = int(self.point[0])
+        if brush.dx < 0.0:
+            return
+        width = max(1,int(abs(brush.dx)))
+        
+        x = int(brush.point[0])
         
         # this is only useful if we are painting both left and right, currently disabled
-        if self.dx < 0.0:
+        if brush.dx < 0.0:
             x -= width
         
         if x < 0:
             width -= x
             x = 0
             
-        window = pygame.Rect((x, int(self.point[1])), (width, 1))
+        window = pygame.Rect((x, int(brush.point[1])), (width, 1))
         h = 12
         
         for i in range(0, 12):
@@ -143,53 +1622,137 @@ class Paintbrush:
                 break
             
             color = pygame.transform.average_color(self.canvas, window)
-            self.nozzles[i] = min(4,(255-color[0])/48)
+            brush.nozzles[i] = min(4,(255-color[0])/48)
             window.move_ip(0, 1)
         
         # clear the area we are painting so it isn't painted again in the future
-        window.topleft = (x, int(self.point[1]))
+        window.topleft = (x, int(brush.point[1]))
         window.height = h
+        window = window.clip(self.canvas_rect)
         self.canvas.fill((255, 255, 255), window)
+        if window.width and window.height:
+            self.recount(window)
+        self.dirty.append(window)
         
-    def send_command(self):
-        # pack two 0-5 values in each byte, and give the first byte a 0xC0 header
-        command = bytearray(6)
-        command[0] = 0xC0
-        for i in range(0, 6):
-            command[i] |= self.nozzles[i*2] << 3
-            command[i] |= self.nozzles[i*2+1]
-        self.port.write(command)
+    def send_command(self, head=0):
+        # the writer packs the schedule for whichever protocol the firmware speaks
+        brush = self.brushes[head]
+        schedule = brush.schedule or [(0.0, brush.nozzles)]
+        brush.writer.send(schedule)
+        if self.recorder:
+            # the bytes the writer sends for it, less the sequence number it
+            # gives a packet
+            if brush.writer.protocol == 'framed':
+                command = frame_packet(0, schedule[:MAX_FRAMES])
+            else:
+                command = legacy_command(average_levels(schedule))
+            self.recorder.command(command, head)
     
     def run(self):
         going = True
         calibrating = True
-        self.new_point()
+        verifying = not self.recalibrate and self.load_calibration()
+        if verifying:
+            print "Found a saved calibration, move the printer head to %s and press any key" % str(self.reference)
+        else:
+            self.new_point()
         
+        active = True
         while going:
-            cam_image = self.camera.update()
+            # between strokes there is no hurry, but while painting every
+            # frame from the camera counts
+            active = self.scheduler.wait(active)
+            self.frame_time = self.scheduler.interval()
+            p = self.profiler
+            p.budget = self.frame_time
+            p.start()
+            self.camera.update()
+            p.stage('capture')
             if calibrating:
-                self.update_display(cam_image)
+                # only converted for the screen while it is being shown
+                self.update_display(self.camera.preview())
             else:
                 self.update_location()
-                self.nozzles = [0]*12
-                if self.painting and self.point != None:
-                    self.calculate_brush()
-                self.send_command()
-                self.update_display(self.canvas)
+                p.stage('locate')
+                # the heads share the canvas and are brushed one after the
+                # other, so what one just painted is already cleared by the
+                # time the next one looks at it
+                for head, brush in enumerate(self.brushes):
+                    brush.reset()
+                    if self.painting and brush.point != None:
+                        self.calculate_brush(head)
+                p.stage('brush')
+                for head in range(len(self.brushes)):
+                    self.send_command(head)
+                p.stage('send')
+                self.update_canvas()
+                active = self.painting and [b for b in self.brushes if b.point != None] != []
+            p.stage('display')
             
             events = pygame.event.get()
             for e in events:
                 if e.type == QUIT or (e.type == KEYDOWN and e.key == K_ESCAPE):
                     going = False
                 elif e.type == KEYDOWN:
-                    if calibrating:
+                    if self.recorder:
+                        self.recorder.key(e.key)
+                    if verifying:
+                        verifying = False
+                        if self.verify():
+                            calibrating = False
+                        else:
+                            self.new_point()
+                    elif calibrating:
                         if not self.calibrate():
                             calibrating = False
                     else:
                         self.painting = not self.painting
                         print "Toggled paintbrush to %d" % self.painting
-                        
-            self.clock.tick(30)
+                        if not self.painting:
+                            # a pause is a good time to keep what is done
+                            self.save_progress()
+            
+            p.stage('events')
+            p.end()
+        
+        self.camera.stop()
+        for brush in self.brushes:
+            brush.writer.stop()
+        if self.canvas is None:
+            self.sampler.flush()
+            print "Loaded %d canvas tiles, evicted %d" % (self.sampler.loads, self.sampler.evictions)
+        self.save_progress()
+        print "Painted %.1f%% of the image" % (100*self.coverage.progress())
+        if self.progress:
+            print "Saved progress to %s" % self.progress
+        for head, brush in enumerate(self.brushes):
+            stats = brush.writer.stats()
+            if len(self.brushes) > 1:
+                print "Head %d:" % head
+            print "Wrote %d commands at %.1f bytes/s, skipped %d unchanged and %d stale" % (stats['written'], stats['bytes_per_second'], stats['skipped'], stats['coalesced'])
+            print "Serial write latency %.1fms average, %.1fms worst" % (stats['latency']*1000, stats['max_latency']*1000)
+            if stats['stalls']:
+                print "Gave up on %d writes that stalled the port" % stats['stalls']
+            if stats['protocol'] == 'framed':
+                print "Framed protocol: %d acknowledged, %d rejected, %d timed out, %d sent again, %.1fms round trip" % (stats['acked'], stats['rejected'], stats['timeouts'], stats['resent'], stats['round_trip']*1000)
+            else:
+                print "Firmware only speaks the legacy protocol"
+        if self.camera.dropped:
+            print "Dropped %d camera frames" % self.camera.dropped
+        if self.camera.tracking:
+            print "Found the LED near its last position %d times, searched the whole frame %d times" % (self.camera.roi_hits, self.camera.full_scans)
+        rates = self.scheduler.rates()
+        if rates['target']:
+            print "Ran at %.1f frames/s painting, for a camera delivering %.1f" % (rates['active'], rates['target'])
+        else:
+            print "Ran at %.1f frames/s painting, without measuring the camera's rate" % rates['active']
+        if rates['idle_target']:
+            print "Ran at %.1f frames/s idle, backing off to %.1f" % (rates['idle'], rates['idle_target'])
+        else:
+            print "Ran at %.1f frames/s idle, as fast as the source went" % rates['idle']
+        if self.profile:
+            self.profiler.dump(self.profile)
+            print "Saved loop timings to %s, %d of %d frames ran over budget" % (self.profile, self.profiler.missed, self.profiler.frames)
                         
 def usage():
     print "Semi-Automatic Paintbrush - by Nirav Patel <nrp@eclecti.cc>"
@@ -203,13 +1766,34 @@ def usage():
     print "  A pygame supported camera modified for infrared."
     print ""
     print "Options:"
-    print "  -h or --help       displays this helpful text"
-    print "  -p or --port       the serial port the Arduino is on (optional)"
-    print "  -w or --width      the width of the canvas in inches (8.0)"
-    print "  -l or --height     the height of the canvas in inches (6.0)"
+    print "  -h or --help          displays this helpful text"
+    print "  -p or --port          the serial port the Arduino is on, or a comma"
+    print "                        separated list with one per head (optional)"
+    print "  -w or --width         the width of the canvas in inches (8.0)"
+    print "  -l or --height        the height of the canvas in inches (6.0)"
+    print "  -a or --average       sample the canvas with average_color (slower)"
+    print "  -t or --threaded      capture camera frames on a separate thread"
+    print "  -r or --roi           track the LED in a window around its last position"
+    print "  -d or --detector      find the LED with mask or numpy[:2|4]"
+    print "                        (numpy for raw capture, mask otherwise)"
+    print "  -k or --latency       predict the brush this many ms ahead (off)"
+    print "  -c or --calibration   where to save calibrations (calibration-*.npz)"
+    print "  -f or --recalibrate   calibrate even if a saved calibration exists"
+    print "  -m or --measure       show loop timings and save them to a .csv or .json"
+    print "  -s or --record        record the session to NAME.log and NAME.npy"
+    print "  -n or --frames        record up to this many camera frames too (0)"
+    print "  -y or --replay        play back a recorded session instead of the camera"
+    print "  -x or --fast          play back as fast as possible, not in real time"
+    print "  -z or --zoom          show the canvas at this scale while painting (1.0)"
+    print "  -g or --tiles         keep the canvas in tiles in this file, for huge canvases"
+    print "  -e or --dither        dither the image with floyd (default), ordered or none"
+    print "  -o or --protocol      talk to the firmware with auto (default), framed or legacy"
+    print "  -i or --capture       capture RGB (default), YUV or raw frames from the camera"
+    print "  -j or --progress      keep what has been painted in this file, to carry on later"
     print ""
     print "Usage:"
     print "  python paintbrush.py -p /dev/ttyUSB0 -w 6.0 -l 8.0 monalisa.jpg"
+    print "  python paintbrush.py -p /dev/ttyUSB0,/dev/ttyUSB1 monalisa.jpg"
     print ""
     print "  Then follow the instructions in the console to calibrate and "
     print "  start drawing."
@@ -218,9 +1802,31 @@ if __name__ == '__main__':
     serialport = None
     w = 6.0
     h = 8.0
+    average_color = False
+    threaded = False
+    tracking = False
+    detector = None
+    latency = None
+    calibration = 'calibration'
+    recalibrate = False
+    profile = None
+    record = None
+    record_frames = 0
+    replay = None
+    realtime = True
+    scale = 1.0
+    tiles = None
+    dithering = 'floyd'
+    protocol = 'auto'
+    capture = 'RGB'
+    progress = None
 
     try:
-        opts,args = getopt.gnu_getopt(sys.argv[1:], "hp:w:l:", ["help", "port=", "width=", "height="])
+        opts,args = getopt.gnu_getopt(sys.argv[1:], "hp:w:l:atrd:k:c:fm:s:n:y:xz:g:e:o:i:j:",
+                                      ["help", "port=", "width=", "height=", "average", "threaded", "roi", "detector=",
+                                       "latency=", "calibration=", "recalibrate", "measure=",
+                                       "record=", "frames=", "replay=", "fast", "zoom=", "tiles=", "dither=", "protocol=",
+                                       "capture=", "progress="])
     except getopt.GetoptError, err:
         print str(err)
         usage()
@@ -231,11 +1837,47 @@ if __name__ == '__main__':
             usage()
             sys.exit()
         elif o in ("-p", "--port"):
-            serialport = a
+            serialport = a.split(',')
         elif o in ("-w", "--width"):
             w = float(a)
         elif o in ("-l", "--height"):
             h = float(a)
+        elif o in ("-a", "--average"):
+            average_color = True
+        elif o in ("-t", "--threaded"):
+            threaded = True
+        elif o in ("-r", "--roi"):
+            tracking = True
+        elif o in ("-d", "--detector"):
+            detector = a
+        elif o in ("-k", "--latency"):
+            latency = float(a)/1000
+        elif o in ("-c", "--calibration"):
+            calibration = a
+        elif o in ("-f", "--recalibrate"):
+            recalibrate = True
+        elif o in ("-m", "--measure"):
+            profile = a
+        elif o in ("-s", "--record"):
+            record = a
+        elif o in ("-n", "--frames"):
+            record_frames = int(a)
+        elif o in ("-y", "--replay"):
+            replay = a
+        elif o in ("-x", "--fast"):
+            realtime = False
+        elif o in ("-z", "--zoom"):
+            scale = float(a)
+        elif o in ("-g", "--tiles"):
+            tiles = a
+        elif o in ("-e", "--dither"):
+            dithering = a
+        elif o in ("-o", "--protocol"):
+            protocol = a
+        elif o in ("-i", "--capture"):
+            capture = a
+        elif o in ("-j", "--progress"):
+            progress = a
     
     if len(args) > 0:
         filename = args[0]
@@ -243,5 +1885,20 @@ if __name__ == '__main__':
         usage()
         sys.exit(0)
         
-    paintbrush = Paintbrush(filename, serialport, (w, h))
+    camera = None
+    port = None
+    if replay:
+        camera = ReplaySource(replay, realtime, make_detector(detector))
+        if serialport is None:
+            # nothing needs to be plugged in to play a session back
+            port = [NullPort() for i in range(camera.heads)]
+        
+    # everything past the canvas size by name, so a new option can't shift the rest
+    paintbrush = Paintbrush(filename, serialport, (w, h), average_color=average_color,
+                            threaded=threaded, tracking=tracking, detector=make_detector(detector),
+                            latency=latency, calibration=calibration, recalibrate=recalibrate,
+                            profile=profile, camera=camera, record=record,
+                            record_frames=record_frames, port=port, scale=scale, tiles=tiles,
+                            dithering=dithering, protocol=protocol, capture=capture,
+                            progress=progress)
     paintbrush.run()
@@ -35,6 +35,28 @@ uint8_t command[6];
 uint8_t command_index = 0;
 uint8_t nozzles[12];
 
+// framed packets, as written by SerialWriter in paintbrush.py: SYNC, the
+// version, a sequence number, a count of frames, each a 16 bit delay in
+// tenths of a millisecond and 6 bytes of levels, then a CRC-8 of it all
+#define SYNC 0x80
+#define VERSION 1
+#define ACK 0x06
+#define NAK 0x15
+#define MAX_FRAMES 8
+// a packet is written all at once, so a gap this long in microseconds
+// means bytes were lost, and the rest of it isn't coming
+#define PACKET_GAP 2000
+uint8_t packet[3 + 8*MAX_FRAMES + 1];
+int packet_length = -1;
+unsigned long last_byte = 0;
+uint8_t last_seq = 0;
+boolean have_seq = false;
+// the frames of the newest packet, and when each one starts
+unsigned long frame_start[MAX_FRAMES];
+uint8_t frame_levels[MAX_FRAMES][12];
+uint8_t frame_count = 0;
+uint8_t frame_next = 0;
+
 void setup()
 {
   setABCDPinMode(abcdA0A3, OUTPUT);  //set the abcd pins as outputs
@@ -46,6 +68,7 @@ void loop()
 {
     while (Serial.available())
         update_command(Serial.read());
+    play_schedule();
     index++;
     word pulse = calculate_pulse();
     spray_ink(pulse);
@@ -54,17 +77,119 @@ void loop()
 // pull in the new nozzle pattens from serial
 void update_command(int incoming)
 {
+    unsigned long now = micros();
+    // waiting on the rest of a broken packet would swallow the ones after it
+    if (packet_length >= 0 && now - last_byte > PACKET_GAP)
+        packet_length = -1;
+    last_byte = now;
+    
+    if (packet_length >= 0) {
+        packet[packet_length++] = incoming;
+        // a bad count would have the body run on into the next packet
+        if (packet_length == 3 && packet[2] > MAX_FRAMES) {
+            reply(NAK, packet[1]);
+            packet_length = -1;
+            return;
+        }
+        if (packet_length >= 3) {
+            uint8_t count = min(packet[2], MAX_FRAMES);
+            if (packet_length == 3 + 8*count + 1) {
+                finish_packet();
+                packet_length = -1;
+            }
+        }
+        return;
+    }
+    // legacy commands never have SYNC in them
+    if (incoming == SYNC) {
+        packet_length = 0;
+        return;
+    }
+    
     // two high bits indicates the first byte in the range of 6
     if ((incoming & 0xC0) == 0xC0)
         command_index = 0;
     // the commands are 3 bits for each nozzle, a 0-6 index into the grayscale array
-    nozzles[command_index*2] = (incoming & 0x38) >> 3;
-    nozzles[command_index*2 + 1] = (incoming & 0x07);
+    nozzles[command_index*2] = clamp_level((incoming & 0x38) >> 3);
+    nozzles[command_index*2 + 1] = clamp_level(incoming & 0x07);
     command_index++;
     // wrap around defensively to avoid memory corruption
     if (command_index > 5) command_index = 0;
 }
 
+// there are only 5 patterns, so keep bad levels from reading past them
+uint8_t clamp_level(uint8_t level)
+{
+    return level > 4 ? 4 : level;
+}
+
+uint8_t crc8(const uint8_t *data, uint8_t length)
+{
+    uint8_t crc = 0;
+    for (uint8_t i = 0; i < length; i++) {
+        crc ^= data[i];
+        for (uint8_t bit = 0; bit < 8; bit++)
+            crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : crc << 1;
+    }
+    return crc;
+}
+
+void reply(uint8_t kind, uint8_t seq)
+{
+    Serial.write(kind);
+    Serial.write(seq);
+    Serial.write((uint8_t)VERSION);
+}
+
+// check a whole packet, answer it, and start playing its frames
+void finish_packet()
+{
+    uint8_t version = packet[0];
+    uint8_t seq = packet[1];
+    uint8_t count = packet[2];
+    uint8_t length = 3 + 8*min(count, MAX_FRAMES);
+    if (count > MAX_FRAMES || version != VERSION || crc8(packet, length) != packet[length]) {
+        reply(NAK, seq);
+        return;
+    }
+    reply(ACK, seq);
+    
+    // a packet without frames is a hello, which starts the sequence over
+    if (count == 0) {
+        have_seq = false;
+        return;
+    }
+    // anything not newer than the last packet arrived late, so drop it
+    if (have_seq && (uint8_t)(seq - last_seq - 1) >= 127)
+        return;
+    have_seq = true;
+    last_seq = seq;
+    
+    // the new schedule replaces whatever is left of the old one
+    play_schedule();
+    unsigned long now = micros();
+    for (uint8_t i = 0; i < count; i++) {
+        uint8_t *frame = packet + 3 + 8*i;
+        frame_start[i] = now + 100UL*(frame[0] | (frame[1] << 8));
+        for (uint8_t j = 0; j < 6; j++) {
+            frame_levels[i][j*2] = clamp_level((frame[2+j] & 0x38) >> 3);
+            frame_levels[i][j*2 + 1] = clamp_level(frame[2+j] & 0x07);
+        }
+    }
+    frame_count = count;
+    frame_next = 0;
+}
+
+// switch to each frame of the schedule once its time comes
+void play_schedule()
+{
+    while (frame_next < frame_count && (long)(micros() - frame_start[frame_next]) >= 0) {
+        for (uint8_t i = 0; i < 12; i++)
+            nozzles[i] = frame_levels[frame_next][i];
+        frame_next++;
+    }
+}
+
 // each 800us timestep, calculate the pulse pattern to use
 word calculate_pulse()
 {
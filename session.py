@@ -0,0 +1,302 @@
+""" Session Recording and Replay for the Semi-Automatic Paintbrush
+
+Copyright (c) 2011, Nirav Patel <http://eclecti.cc>
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+Records what a point source sees, along with the keys pressed and the
+commands sent to the InkShield, so that a session can be played back
+later without the camera or the Arduino.  A session is two files:
+
+name.log - An append-only log of timestamped records
+name.npy - The camera frames as a stack of brightness images, if recorded
+
+SessionRecorder - Wraps a point source and records everything it returns
+ReplaySource - Plays a recorded session back in place of an IRCamera
+NullPort - Stands in for the serial port to the Arduino
+"""
+
+import os
+import time
+import math
+import struct
+import numpy
+from numpy.lib import format
+import pygame
+from pygame.locals import *
+from homography import FakeSource, MaskDetector
+
+# every record is a kind, a timestamp, and a length prefixed payload
+RECORD = struct.Struct('<cdH')
+POINT = struct.Struct('<dd')
+
+class SessionRecorder:
+    """Wraps a point source and records everything it returns
+    
+    update() -- Read in, record and return a new image from the source
+    get_point() -- Return and record the point found by the source
+    get_points(count) -- Return and record the points found by the source
+    key(key) -- Record a key press
+    command(command, head) -- Record a command sent to an InkShield
+    close() -- Finish the recording
+    
+    frames is how many camera frames to keep room for.  With none, only the
+    points are recorded, which is enough to replay everything but detection.
+    Anything else, like resolution or timestamp, comes from the source.
+    """
+    
+    def __init__(self, source, name, frames=0):
+        self.source = source
+        self.name = name
+        self.log = open(name + '.log', 'wb')
+        w, h = source.resolution
+        self.record('R', struct.pack('<HH', w, h))
+        
+        self.capacity = frames
+        self.count = 0
+        self.frames = None
+        if not frames and os.path.exists(name + '.npy'):
+            # don't leave frames from an older session to be replayed with this one
+            os.remove(name + '.npy')
+        if frames:
+            # the frames go straight to disk through a memory map
+            self.frames = format.open_memmap(name + '.npy', 'w+', numpy.uint8, (frames, w, h))
+    
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+    
+    def record(self, kind, payload='', timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self.log.write(RECORD.pack(kind, timestamp, len(payload)) + payload)
+    
+    def update(self):
+        """Read in, record and return a new image from the source"""
+        image = self.source.update()
+        timestamp = self.source.timestamp or time.time()
+        index = -1
+        if self.frames is not None and self.count < self.capacity:
+            # the camera is filtered for IR, so brightness is all there is
+            index = self.count
+            luminance = self.source.luminance()
+            self.frames[index] = luminance
+            del luminance
+            self.count += 1
+        self.record('U', struct.pack('<i', index), timestamp)
+        return image
+    
+    def get_point(self):
+        """Return and record the point found by the source"""
+        point = self.source.get_point()
+        if point:
+            self.record('P', POINT.pack(point[0], point[1]))
+        else:
+            self.record('P', POINT.pack(float('nan'), float('nan')))
+        return point
+    
+    def get_points(self, count):
+        """Return and record the points found by the source"""
+        points = self.source.get_points(count)
+        payload = ''.join([POINT.pack(p[0], p[1]) for p in points])
+        self.record('M', payload)
+        return points
+    
+    def key(self, key):
+        """Record a key press"""
+        self.record('K', struct.pack('<i', key))
+    
+    def command(self, command, head=0):
+        """Record a command sent to an InkShield"""
+        if head:
+            # commands to any head but the first say which one they went to
+            self.record('D', struct.pack('<B', head) + bytes(command))
+        else:
+            self.record('C', bytes(command))
+    
+    def stop(self):
+        self.close()
+        self.source.stop()
+    
+    def close(self):
+        """Finish the recording"""
+        if self.log.closed:
+            return
+        self.log.close()
+        if self.frames is None:
+            return
+        
+        shape = self.frames.shape
+        self.frames.flush()
+        self.frames = None
+        # shrink the stack down to the frames that were actually recorded
+        f = open(self.name + '.npy', 'r+b')
+        version = format.read_magic(f)
+        start = f.tell()
+        format.read_array_header_1_0(f)
+        offset = f.tell()
+        header = "{'descr': '|u1', 'fortran_order': False, 'shape': %r, }" % ((self.count,) + shape[1:],)
+        # keep the header the same length so the data doesn't have to move
+        header = header.ljust(offset - start - 3) + '\n'
+        f.seek(start)
+        f.write(struct.pack('<H', len(header)) + header)
+        f.truncate(offset + self.count*shape[1]*shape[2])
+        f.close()
+
+class ReplaySource(FakeSource):
+    """Plays a recorded session back in place of an IRCamera
+    
+    update() -- Return the next recorded image
+    get_point() -- Return the next recorded point, or detect it in the image
+    get_points(count) -- Return the next recorded points, or detect them in the image
+    sent(head) -- Return the commands recorded as sent to a head so far
+    
+    Recorded key presses are posted as pygame events at the point they
+    happened, and a QUIT is posted when the session runs out.  With realtime
+    the session plays at its original pace, otherwise as fast as it is read.
+    Points are detected in the recorded frames, but the recording may stop
+    keeping frames before the session ends, and after that the recorded
+    points are used instead.  heads is how many print heads the session
+    sent commands to.
+    """
+    
+    def __init__(self, name, realtime=True, detector=None):
+        f = open(name + '.log', 'rb')
+        data = f.read()
+        f.close()
+        self.records = []
+        i = 0
+        while i + RECORD.size <= len(data):
+            kind, timestamp, length = RECORD.unpack_from(data, i)
+            i += RECORD.size
+            self.records.append((kind, timestamp, data[i:i+length]))
+            i += length
+        
+        kind, start, payload = self.records[0]
+        self.resolution = struct.unpack('<HH', payload)
+        # heads past the first only show up in the commands sent to them
+        self.heads = 1
+        for kind, timestamp, payload in self.records:
+            if kind == 'D':
+                self.heads = max(self.heads, struct.unpack_from('<B', payload)[0] + 1)
+        self.cursor = 1
+        self.realtime = realtime
+        self.paced = realtime
+        self.start = start
+        self.offset = None
+        self.timestamp = None
+        self.dropped = 0
+        self.tracking = False
+        
+        self.frames = None
+        if os.path.exists(name + '.npy'):
+            self.frames = numpy.load(name + '.npy', mmap_mode='r')
+            if detector is None:
+                detector = MaskDetector()
+        self.detector = detector
+        self.snapshot = pygame.surface.Surface(self.resolution, 0, 32)
+        # whether the snapshot is the frame recorded with this update
+        self.framed = False
+        self.points = []
+        self.point_sets = []
+        # timestamped commands, by head
+        self.commands = {}
+        self.finished = False
+    
+    def update(self):
+        """Return the next recorded image"""
+        n = len(self.records)
+        while self.cursor < n and self.records[self.cursor][0] != 'U':
+            self.cursor += 1
+        if self.cursor >= n:
+            if not self.finished:
+                self.finished = True
+                pygame.event.post(pygame.event.Event(QUIT))
+            return self.snapshot
+        
+        kind, timestamp, payload = self.records[self.cursor]
+        self.show(timestamp, struct.unpack('<i', payload)[0])
+        self.cursor += 1
+        
+        # everything up to the next frame happened while this one was current
+        self.points = []
+        self.point_sets = []
+        while self.cursor < n and self.records[self.cursor][0] != 'U':
+            kind, timestamp, payload = self.records[self.cursor]
+            if kind == 'P':
+                self.points.append(POINT.unpack(payload))
+            elif kind == 'M':
+                self.point_sets.append([POINT.unpack_from(payload, i) for i in range(0, len(payload), POINT.size)])
+            elif kind == 'K':
+                key = struct.unpack('<i', payload)[0]
+                pygame.event.post(pygame.event.Event(KEYDOWN, key=key, mod=0, unicode=u''))
+            elif kind == 'C':
+                self.commands.setdefault(0, []).append((timestamp, payload))
+            elif kind == 'D':
+                head = struct.unpack_from('<B', payload)[0]
+                self.commands.setdefault(head, []).append((timestamp, payload[1:]))
+            self.cursor += 1
+        return self.snapshot
+    
+    def show(self, timestamp, index):
+        now = time.time()
+        if self.offset is None:
+            self.offset = now - timestamp
+        if self.realtime:
+            wait = timestamp + self.offset - now
+            if wait > 0:
+                time.sleep(wait)
+        self.timestamp = timestamp + self.offset
+        
+        self.framed = self.frames is not None and 0 <= index < len(self.frames)
+        if self.framed:
+            pixels = pygame.surfarray.pixels3d(self.snapshot)
+            pixels[...] = self.frames[index][:, :, numpy.newaxis]
+            del pixels
+    
+    def get_point(self):
+        """Return the next recorded point, or detect it in the image"""
+        recorded = None
+        if self.points:
+            x, y = self.points.pop(0)
+            if not math.isnan(x):
+                recorded = (x, y)
+        if self.framed:
+            centroid, bounds = self.detector.find(self.snapshot)
+            return centroid
+        return recorded
+    
+    def get_points(self, count):
+        """Return the next recorded points, or detect them in the image"""
+        recorded = []
+        if self.point_sets:
+            recorded = self.point_sets.pop(0)
+        if self.framed:
+            return [centroid for centroid, bounds in self.detector.find_all(self.snapshot, count)]
+        return recorded
+    
+    def sent(self, head=0):
+        """Return the commands recorded as sent to a head so far
+        
+        Each is a timestamp and the bytes sent, either a 6 byte legacy
+        command or a framed packet starting with SYNC.
+        """
+        return list(self.commands.get(head, []))
+
+class NullPort:
+    """Stands in for the serial port to the Arduino"""
+    
+    def __init__(self):
+        self.written = 0
+    
+    def write(self, data):
+        self.written += len(data)